@@ -1,21 +1,41 @@
 import os
+import sys
 import argparse
 import asyncio
-import websockets
-import shlex
+import re
 import tempfile
-import readline
-from termcolor import colored, cprint
+import uuid
+from contextlib import asynccontextmanager
 from pathlib import Path
-from kazoo.client import KazooClient, Lock
-from typing import Callable, Optional
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Tuple
+
+# kazoo, websockets & readline are imported on first use, keeps CLI start-up (and --help) cheap
+if TYPE_CHECKING:
+    import websockets
+    from kazoo.client import Lock
+
+# termcolor is optional, print without colors if it is missing
+try:
+    from termcolor import colored
+except ImportError:
+    def colored(text, *args, **kwargs) -> str:
+        return str(text)
 
 from nfs.fs import FileNode
 from nfs.packet import OpenRequest, OpenResponse, \
     CloseRequest, CloseResponse, \
     ReadRequest, ReadResponse, \
-    WriteRequest, WriteResponse
-from nfs.constants import NFS_SERVER, NFS_PORT, NFS_FS_PORT, ZK_HOST
+    WriteRequest, WriteResponse, \
+    BufferPool, iter_file_chunks, recv_file_chunks, set_socket_buffers
+from nfs.constants import NFS_SERVER, NFS_PORT, NFS_FS_PORT, ZK_HOST, \
+    CHUNK_SIZE, TRANSFER_CONCURRENCY
+
+# uvloop is optional, fall back to the default asyncio event loop if it is missing
+try:
+    import uvloop
+    uvloop.install()
+except ImportError:
+    pass
 
 # Global WebSocket connection variables
 nfs_server_uri = f"ws://{NFS_SERVER}:{NFS_PORT}"
@@ -23,6 +43,19 @@ file_transfer_server_uri = f"ws://{NFS_SERVER}:{NFS_FS_PORT}"
 
 HISTORY_FILE = "nfs_client_history.txt"
 
+# `read` only displays the first READ_DISPLAY_LIMIT bytes of the cached file
+READ_DISPLAY_LIMIT = 4 << 10
+
+# 8-bit binary string of every byte value, used to render the binary view
+BINARY_REPR = [f"{b:08b}" for b in range(256)]
+
+# A token is a double-quoted string, a single-quoted string or a run of non-space characters
+TOKEN_RE = re.compile(r'''"([^"]*)"|'([^']*)'|(\S+)''')
+
+def split_command(command: str) -> List[str]:
+    """ Split a CLI line into arguments, honouring simple quoting (no escapes) """
+    return [m.group(m.lastindex) for m in TOKEN_RE.finditer(command)]
+
 class Command:
     def __init__(
         self, 
@@ -85,23 +118,32 @@ class NFSClient:
     </ul>
     '''
     
-    def __init__(self, host, port, binary_port, zk_host):
+    def __init__(self, host, port, binary_port, zk_host, concurrency: int = TRANSFER_CONCURRENCY):
         self.host = host
         self.port = port
         self.binary_port = binary_port
         self.zk_host = zk_host
         
+        # Connected on the first lock, so a slow ZooKeeper does not hold up the prompt
+        from kazoo.client import KazooClient
         self.zk = KazooClient(hosts=zk_host)
-        self.zk.start()
         
         # Tracking the opened file
         self.current_file_node: FileNode = None
-        self.current_zk_lock: Lock = None
+        self.current_zk_lock: 'Lock' = None
         
         # Init a temporary folder (to store the cached file)
         self.temp_folder = tempfile.mkdtemp(prefix="buf")
         self.temp_file: Path = None
         
+        # Long-lived WebSocket connections, keyed by (URI, channel) and reused across RPCs.
+        # Large uploads are split over `concurrency` channels to the file transfer server.
+        self.concurrency = concurrency
+        self._ws_conns: Dict[Tuple[str, int], 'websockets.ClientConnection'] = {}
+        self._ws_locks: Dict[Tuple[str, int], asyncio.Lock] = {}
+        # Reusable buffers for streaming uploads, one per parallel connection
+        self.buffer_pool = BufferPool(count=max(concurrency, 1))
+        
         # Set up the commands
         self.commands = [
             Command(
@@ -173,11 +215,17 @@ class NFSClient:
             )
         ]
         
-        # Set up command history
-        self.setup_history()
+        # Command name -> Command, for dispatching (the list keeps the help order)
+        self._cmd_map: Dict[str, Command] = {cmd.name: cmd for cmd in self.commands}
+        
+        # Set up command history (interactive sessions only, piped/scripted input skips readline)
+        self.interactive: bool = sys.stdin.isatty()
+        if self.interactive:
+            self.setup_history()
     
     def setup_history(self):
         """ Set up the command history using the readline module """
+        import readline
         try:
             readline.read_history_file(HISTORY_FILE)
         except FileNotFoundError:
@@ -185,25 +233,81 @@ class NFSClient:
 
         readline.set_history_length(100)  # Limit the history size to 100 commands
     
+    async def _get_ws(self, uri, channel: int = 0) -> 'websockets.ClientConnection':
+        """ Return the cached connection to uri (one per channel), connecting lazily """
+        import websockets
+        from websockets.protocol import State
+        websocket = self._ws_conns.get((uri, channel))
+        if websocket is None or websocket.state is not State.OPEN:
+            # File data is mostly incompressible, skip permessage-deflate
+            if uri == file_transfer_server_uri:
+                # Uploads are sent in CHUNK_SIZE fragments, buffer a whole one before waiting on the socket
+                websocket = await websockets.connect(uri, compression=None, max_size=None, write_limit=CHUNK_SIZE)
+                set_socket_buffers(websocket)
+            else:
+                websocket = await websockets.connect(uri, compression=None, max_size=None)
+            self._ws_conns[(uri, channel)] = websocket
+        return websocket
+    
+    async def _drop_ws(self, uri, channel: int = 0):
+        """ Forget (and close) the cached connection to uri """
+        websocket = self._ws_conns.pop((uri, channel), None)
+        if websocket is not None:
+            await websocket.close()
+    
     async def websocket_comm(self, uri, data) -> bytes:
-        """ Connect to the websocket server and send the command """
-        async with websockets.connect(uri) as websocket:
-            await websocket.send(data)
-            response = await websocket.recv(decode=False)
-            # await websocket.close()
-            return response
+        """ Send the command over the persistent connection to uri and wait for the reply """
+        import websockets
+        # One request in flight per connection, keeps the request/response pairing intact
+        lock = self._ws_locks.setdefault((uri, 0), asyncio.Lock())
+        async with lock:
+            websocket = await self._get_ws(uri)
+            try:
+                await websocket.send(data)
+            except websockets.exceptions.ConnectionClosed:
+                # Stale connection (e.g. the server restarted), reconnect once and resend
+                await self._drop_ws(uri)
+                websocket = await self._get_ws(uri)
+                await websocket.send(data)
+            
+            try:
+                return await websocket.recv(decode=False)
+            except BaseException:
+                # A reply left unread (e.g. cancelled) would be taken for the answer to the next request
+                await self._drop_ws(uri)
+                raise
+    
+    @asynccontextmanager
+    async def ws_session(self, uri, channel: int = 0):
+        """ Hold the connection to uri for a multi-message exchange (a header followed by streamed file contents) """
+        async with self._ws_locks.setdefault((uri, channel), asyncio.Lock()):
+            websocket = await self._get_ws(uri, channel)
+            try:
+                yield websocket
+            except BaseException:
+                # Whatever broke the exchange (lost connection, local I/O error, cancellation, ...), the connection
+                # may be mid-message (a half-read stream, a header without its contents), never reuse it
+                await self._drop_ws(uri, channel)
+                raise
+    
+    async def close(self):
+        """ Close all cached WebSocket connections """
+        for uri, channel in list(self._ws_conns):
+            await self._drop_ws(uri, channel)
+        self._ws_locks.clear()
 
     async def handle_command(self, command):
         """ Handle commands from CLI or shell """
-        args = shlex.split(command)
+        # Parsed once here, handlers get the split arguments (including the command name)
+        args = split_command(command)
+        if not args:
+            return
 
-        # Find the command in the available commands list
-        matched_command = next((cmd for cmd in self.commands if cmd.name == args[0]), None)
+        matched_command = self._cmd_map.get(args[0])
 
         if matched_command:
             # Call the handler for the matched command
-            # await matched_command.handler(*args[1:])
-            await matched_command.handler(command)
+            await matched_command.handler(args)
 
             # If there is a callback, execute it after the handler
             if matched_command.callback:
@@ -214,8 +318,8 @@ class NFSClient:
     '''
     Command handlers
     '''
-    async def handle_open(self, command):
-        parts = shlex.split(command)
+    async def handle_open(self, args: List[str]):
+        parts = args
         if not len(parts) == 2:
             print("open takes one argument.")
             return
@@ -227,52 +331,78 @@ class NFSClient:
         if not await self.lock(FileNode("", Path(file_path))):
             return
         
-        openRequest = OpenRequest()
-        response = await self.websocket_comm(
-            nfs_server_uri,
-            openRequest.encode(Path(file_path))
-        )
-        
-        openResponse = OpenResponse()
-        openResponse.decode(response)
-        
-        if not openResponse.OK:
-            print(colored(openResponse.message, "red"))
-            return
-        
-        self.current_file_node = openResponse.file_node
-        
-        print(colored(openResponse.message, "light_blue"))
-        
-        # Fetch the file first & cached it
-        # Future implementation could be to fetch it in the BG (non-blocking)
-        readRequest = ReadRequest()
-        response = await self.websocket_comm(
-            nfs_server_uri,
-            readRequest.encode(
-                file_node=self.current_file_node
+        # Every way out short of a cached copy (error reply, lost connection, ...) releases the lock again
+        opened = False
+        try:
+            openRequest = OpenRequest()
+            response = await self.websocket_comm(
+                nfs_server_uri,
+                openRequest.encode(Path(file_path))
             )
-        )
-        
-        readResponse = ReadResponse()
-        readResponse.decode(response)
-        
-        file_node: FileNode = readResponse.file_node
-        file_data: bytes = readResponse.data
-        file_id: str = file_node.file_id
-        
-        temp_file_path = os.path.join(self.temp_folder, file_id)
-        self.temp_file = Path(temp_file_path)
-        bytes_written: int = -1
-        with open(self.temp_file, "wb") as file:
-            bytes_written = file.write(file_data)
-        
-        print(colored(file_node, "yellow"))
-        
-        assert bytes_written == file_node.size
+            
+            openResponse = OpenResponse()
+            openResponse.decode(response)
+            
+            if not openResponse.OK:
+                print(colored(openResponse.message, "red"))
+                return
+            
+            self.current_file_node = openResponse.file_node
+            
+            print(colored(openResponse.message, "light_blue"))
+            
+            # Fetch the file first & cached it, over the dedicated file transfer connection
+            # Future implementation could be to fetch it in the BG (non-blocking)
+            readRequest = ReadRequest()
+            readResponse = ReadResponse()
+            bytes_written: int = 0
+            
+            async with self.ws_session(file_transfer_server_uri) as websocket:
+                await websocket.send(
+                    readRequest.encode(
+                        file_node=self.current_file_node
+                    )
+                )
+                readResponse.decode(await websocket.recv(decode=False))
+                
+                if not readResponse.OK:
+                    print(colored(readResponse.message, "red"))
+                    return
+                
+                # The contents follow as one fragmented message, write them to the cache as they arrive
+                temp_file = Path(os.path.join(self.temp_folder, self.current_file_node.file_id))
+                fd = os.open(temp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
+                try:
+                    try:
+                        # The size is known up front, reserve the blocks before the contents arrive
+                        if readResponse.length > 0 and hasattr(os, 'posix_fallocate'):
+                            os.posix_fallocate(fd, 0, readResponse.length)
+                        bytes_written = await recv_file_chunks(websocket, fd)
+                    finally:
+                        os.close(fd)
+                except BaseException:
+                    # The preallocated file already has the full size, a partial download must not be kept
+                    os.unlink(temp_file)
+                    raise
+            
+            file_node: FileNode = readResponse.file_node
+            
+            if not bytes_written == readResponse.length == file_node.size:
+                os.unlink(temp_file)
+                print(colored(f"Download of File {file_path} is incomplete ({bytes_written} of {readResponse.length} bytes).", "red"))
+                return
+            
+            # Only a complete download becomes the cached copy
+            self.temp_file = temp_file
+            opened = True
+            
+            print(colored(file_node, "yellow"))
+        finally:
+            if not opened:
+                await self._abandon_open()
     
-    async def handle_close(self, command):
-        parts = shlex.split(command)
+    async def handle_close(self, args: List[str]):
+        parts = args
         if len(parts) > 1:
             print("close does not take any arguments.")
             return
@@ -284,36 +414,37 @@ class NFSClient:
         
         temp_file_size:int = os.path.getsize(self.temp_file)
         assert temp_file_node.size == temp_file_size
-        data: bytes = None
-        
-        with open(self.temp_file, "rb") as file:
-            data = file.read()
-        
-        # Write file to NFS server
-        writeRequest = WriteRequest()
-        response = await self.websocket_comm(
-            nfs_server_uri,
-            writeRequest.encode(
-                temp_file_node,
-                data=data
-            )
-        )
         
-        writeResponse = WriteResponse()
-        writeResponse.decode(response)
-        
-        if not writeResponse.OK:
-            print(colored(writeResponse.message, "red"))
+        # Write file to NFS server over the dedicated file transfer connection(s),
+        # large files are split into ranges that are uploaded in parallel
+        upload: Optional[str] = None
+        if temp_file_size <= CHUNK_SIZE or self.concurrency <= 1:
+            ranges = [(None, temp_file_size)]
+        else:
+            step = -(-temp_file_size // self.concurrency)
+            ranges = [(offset, min(step, temp_file_size - offset)) for offset in range(0, temp_file_size, step)]
+            # Ties the ranges (and the close below) to this upload, the server only swaps in ranges sent with it
+            upload = uuid.uuid4().hex
+        
+        writeResponses = await asyncio.gather(*(
+            self.write_part(temp_file_node, offset, length, channel, upload)
+            for channel, (offset, length) in enumerate(ranges)
+        ))
+        
+        failed = [writeResponse for writeResponse in writeResponses if not writeResponse.OK]
+        if failed:
+            print(colored(failed[0].message, "red"))
             return
         
-        print(colored(writeResponse.message, "light_blue"))
+        print(colored(writeResponses[0].message, "light_blue"))
         
         # Continue with closing the file...
         closeRequest = CloseRequest()
         response = await self.websocket_comm(
             nfs_server_uri,
             closeRequest.encode(
-                temp_file_node
+                temp_file_node,
+                upload=upload
             )
         )
         
@@ -334,7 +465,32 @@ class NFSClient:
         print(colored(closeResponse.message, "light_blue"))
         print(colored(closeResponse.file_node, "yellow"))
     
-    async def handle_write(self, command):
+    async def write_part(self, file_node: FileNode, offset: Optional[int], length: int, channel: int = 0,
+                         upload: Optional[str] = None) -> WriteResponse:
+        """ Upload length bytes of the cached file starting at offset (offset None: the whole file), as part of upload """
+        writeRequest = WriteRequest()
+        writeResponse = WriteResponse()
+        
+        # The header is followed by the contents streamed chunk by chunk
+        async with self.ws_session(file_transfer_server_uri, channel) as websocket:
+            await websocket.send(
+                writeRequest.encode(
+                    file_node,
+                    offset=offset,
+                    length=None if offset is None else length,
+                    upload=upload
+                )
+            )
+            fd = os.open(self.temp_file, os.O_RDONLY)
+            try:
+                await websocket.send(iter_file_chunks(fd, self.buffer_pool, offset=offset or 0, length=length))
+            finally:
+                os.close(fd)
+            writeResponse.decode(await websocket.recv(decode=False))
+        
+        return writeResponse
+    
+    async def handle_write(self, args: List[str]):
         if not self.has_file_open():
             print("No File open.")
             return
@@ -346,14 +502,15 @@ class NFSClient:
         
         content = None
         
-        # Check if there is a file redirection (<)
-        if "<" in command:
-            # Split the command at the redirection operator
-            command_parts = command.split("<")
-            
+        # Check if there is a file redirection (`< file` or `<file`)
+        redirect = next((i for i, arg in enumerate(args) if arg.startswith("<")), None)
+        if redirect is not None:
             # The main write command and the local file to redirect from
-            file_command = shlex.split(command_parts[0].strip())    # Main write command
-            local_file = command_parts[1].strip()                   # The file to redirect from
+            file_command = args[:redirect]                          # Main write command
+            if args[redirect] == "<":
+                local_file = args[redirect + 1]                     # The file to redirect from
+            else:
+                local_file = args[redirect][1:]
 
             # Check for the -b flag for binary data
             if '-b' in file_command:
@@ -377,7 +534,7 @@ class NFSClient:
         else:
             # Without any redirection
             # write <offset> [-b] <string_data>
-            file_command = shlex.split(command)[1:]
+            file_command = args[1:]
             
             if '-b' in file_command:
                 binary_mode = True
@@ -423,14 +580,18 @@ class NFSClient:
                 bytes_written = file.write(content)
         self.current_file_node.size += bytes_written
         
-    async def handle_read(self, command):
+    async def handle_read(self, args: List[str]):
         if not self.has_file_open():
             print("No File open.")
             return
 
-        # Read the entire cached file into memory
+        # Read (the start of) the cached file into memory
         with open(self.temp_file, "rb") as file:
-            data: bytes = file.read()
+            data: bytes = file.read(READ_DISPLAY_LIMIT)
+        
+        file_size: int = os.path.getsize(self.temp_file)
+        if file_size > READ_DISPLAY_LIMIT:
+            print(colored(f"Showing the first {READ_DISPLAY_LIMIT} of {file_size} bytes.", "yellow"))
 
         # 1. Raw bytes
         print(colored("Raw:", "cyan"))
@@ -438,15 +599,15 @@ class NFSClient:
         print()
 
         # 2. Binary representation
-        # Join each byte formatted as an 8-bit binary string, separated by spaces
-        binary_repr = " ".join(f"{b:08b}" for b in data)
+        # Join each byte formatted as an 8-bit binary string (table lookup), separated by spaces
+        binary_repr = " ".join(map(BINARY_REPR.__getitem__, data))
         print(colored("Binary:", "cyan"))
         print(binary_repr)
         print()
 
         # 3. Hex representation
-        # data.hex() returns a continuous hex string; split into byte-pairs for readability
-        hex_pairs = " ".join(data.hex()[i:i+2] for i in range(0, len(data.hex()), 2))
+        # Byte-pairs separated by spaces for readability (the separator is inserted by bytes.hex itself)
+        hex_pairs = data.hex(" ")
         print(colored("HEX:", "cyan"))
         print(hex_pairs)
         print()
@@ -462,18 +623,24 @@ class NFSClient:
             print(colored("UTF-8 (with errors replaced):", "cyan"))
             print(text)
     
-    async def handle_delete(self, command):
+    async def handle_delete(self, args: List[str]):
         '''
         TODO: To be implemented...
         '''
         pass
     
-    async def handle_help(self, command):
+    async def handle_help(self, args: List[str]):
         """ Prints how to use the CLI """
         print("NFS Client CLI Usage:")
         for command in self.commands:
             print(command.get_help_msg())
     
+    async def _abandon_open(self):
+        """ Forget a file whose open failed half-way, and release the lock taken for it """
+        self.current_file_node = None
+        self.temp_file = None
+        await self.zk_unlock()
+    
     def has_file_open(self) -> bool:
         return not (self.current_file_node == None or self.current_zk_lock == None or self.temp_file == None)
     
@@ -512,11 +679,18 @@ class NFSClient:
 
         return True
 
+    async def _ensure_zk(self):
+        """ Connect to Zookeeper if not connected yet (blocking, so run off the event loop) """
+        if not self.zk.connected:
+            await asyncio.get_running_loop().run_in_executor(None, self.zk.start)
+
     async def zk_lock(self, lock_path):
         """ Acquire lock in Zookeeper """
+        await self._ensure_zk()
         lock = self.zk.Lock(lock_path, "client_lock")
         print("Attempting to acquire lock...")
-        lock.acquire()
+        # acquire() blocks until the lock is ours, keep the event loop free meanwhile
+        await asyncio.get_running_loop().run_in_executor(None, lock.acquire)
         assert lock.is_acquired == True
         self.current_zk_lock = lock
         print(f"Lock acquired at {lock_path}")
@@ -529,7 +703,7 @@ class NFSClient:
         lock = self.current_zk_lock
         lock_path = lock.path
         print("Attempting to release lock...")
-        lock.release()
+        await asyncio.get_running_loop().run_in_executor(None, lock.release)
         assert lock.is_acquired == False
         self.current_zk_lock = None
         print(f"Lock released at {lock_path}")
@@ -537,23 +711,41 @@ class NFSClient:
     def start_cli(self):
         """ Start the interactive CLI for the client """
         print("NFS Client CLI by JUN WEI WANG (22302016002). Type 'help' for available commands.")
+        # One event loop for the whole session, keeps the cached connections alive between commands
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
         while True:
             try:
-                bang = colored("nfs> ", "green")
-                command = input(bang)
+                if self.interactive:
+                    bang = colored("nfs> ", "green")
+                    command = input(bang)
+                else:
+                    command = sys.stdin.readline()
+                    if not command:
+                        break   # EOF
+                    command = command.rstrip("\n")
                 if command.strip().lower() == 'exit':
                     break
+                if not command.strip():
+                    continue
 
                 # Save the command to history
-                readline.add_history(command)
-                asyncio.run(self.handle_command(command))
+                if self.interactive:
+                    import readline
+                    readline.add_history(command)
+                loop.run_until_complete(self.handle_command(command))
 
             except Exception as e:
                 print(f"Error: {e}")
                 continue
 
+        loop.run_until_complete(self.close())
+        loop.close()
+
         # Save history when exiting
-        readline.write_history_file(HISTORY_FILE)
+        if self.interactive:
+            import readline
+            readline.write_history_file(HISTORY_FILE)
 
 def parse_args():
     parser = argparse.ArgumentParser(description="NFS Client (WebSocket) CLI by JUN WEI WANG (22302016002)")
@@ -561,9 +753,10 @@ def parse_args():
     parser.add_argument('--port', type=int, default=NFS_PORT, help="Port number for the WebSocket server")
     parser.add_argument('--binary-port', type=int, default=NFS_FS_PORT, help="Port number for the binary WebSocket server")
     parser.add_argument('--zk-host', type=str, default=ZK_HOST, help="Zookeeper server host")
+    parser.add_argument('--concurrency', type=int, default=TRANSFER_CONCURRENCY, help="Number of parallel connections used to upload large files")
     return parser.parse_args()
 
 if __name__ == "__main__":
     args = parse_args()
-    client = NFSClient(args.host, args.port, args.binary_port, args.zk_host)
+    client = NFSClient(args.host, args.port, args.binary_port, args.zk_host, args.concurrency)
     client.start_cli()
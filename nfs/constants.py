@@ -11,6 +11,14 @@ NFS_SERVER      = 'localhost'
 NFS_PORT        = 2050
 NFS_FS_PORT = 2051
 
+# File contents are streamed as fragments of (at most) this size
+CHUNK_SIZE      = 1 << 20
+# Parallel connections used to upload files larger than CHUNK_SIZE
+TRANSFER_CONCURRENCY = 4
+# Kernel send/receive buffer size for file transfer sockets, only applied where net.core.{w,r}mem_max
+# were raised to at least this much (TCP autotuning is left alone otherwise, see set_socket_buffers)
+SOCKET_BUFFER_SIZE = 4 << 20
+
 # Default ZooKeeper connection details
 ZK_HOST         = 'localhost'
 ZK_PORT         = 2181
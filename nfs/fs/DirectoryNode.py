@@ -24,13 +24,16 @@ __version__         = "1.0.0"
 __maintainer__      = "JUN WEI WANG"
 __email__           = "wjw_03@outlook.com"
 
+import sys
 import time
 from pathlib import Path
-from typing import List, Dict
+from typing import Iterator, List, Dict, Tuple
 
 from .FileNode import FileNode
 
 class DirectoryNode:
+    KIND = 'd'    # Node type tag, cheaper to check than isinstance() in tree walks
+    
     def __init__(self, name: str):
         """
         Initializes a new directory node with the specified name and an empty dictionary of child nodes (which can be files or directories).
@@ -54,11 +57,23 @@ class DirectoryNode:
         """
         if name not in self.children:
             new_file = FileNode(name, file_path)
-            file_path = Path(new_file.file_path)
             self.children[name] = new_file
             return new_file
         raise FileExistsError(f"File {name} already exists")
 
+    def get_or_create_file(self, name: str, file_path: Path) -> Tuple[FileNode, bool]:
+        """
+        Returns the child with the given name, creating it as a new file if there is none (one lookup either way).
+        The second item tells whether the file was created, raises an IsADirectoryError if name is a directory.
+        """
+        node = self.children.get(name)
+        if node is not None:
+            if not node.KIND == 'f':
+                raise IsADirectoryError(f"{name} is a directory")
+            return node, False
+        node = self.children[name] = FileNode(name, file_path)
+        return node, True
+
     def mutate_file(self, name: str, file_node: FileNode) -> FileNode:
         """
         Mutates the FileNode by modifying its name, content, or both.
@@ -78,76 +93,90 @@ class DirectoryNode:
         """
         Deletes the subdirectory with the given name from the current directory if it exists. If the directory doesn't exist, raises a FileNotFoundError.
         """ 
-        if name in self.children and isinstance(self.children[name], DirectoryNode):
+        if name in self.children and self.children[name].KIND == 'd':
             node = self.children[name]
             if len(node.children) == 0:
                 deleted_directory_node = self.children[name]
                 del self.children[name]
                 return []
             if not len(node.children) == 0 and recursive:
-                ids: List[str] = self._collect_file_ids(node)
+                ids: List[str] = list(node._iter_file_ids())
                 return ids
             else:
                 raise EnvironmentError("Directory is not empty.")
         else:
             raise FileNotFoundError(f"Directory {name} not found")
         
-    def _collect_file_ids(self, node: 'DirectoryNode') -> List[str]:
-        """
-        Recursively collect file_ids from all FileNodes in this directory and its subdirectories.
-        """
-        file_ids = []
-        for child in node.children.values():
-            if isinstance(child, FileNode):
-                file_ids.append(child.file_id)
-            elif isinstance(child, DirectoryNode):
-                # Recurse into subdirectories
-                file_ids.extend(self._collect_file_ids(child))
-        return file_ids
+    def _iter_file_ids(self) -> Iterator[str]:
+        """
+        Iteratively yields the file_ids of all FileNodes in this directory and its subdirectories.
+        """
+        stack: List['DirectoryNode'] = [self]
+        while stack:
+            node = stack.pop()
+            for child in node.children.values():
+                if child.KIND == 'f':
+                    yield child.file_id
+                elif child.KIND == 'd':
+                    stack.append(child)
 
     def delete_file(self, name: str) -> FileNode:
         """
         Deletes the file with the given name from the current directory and removes it from disk. If the file doesn't exist, raises a FileNotFoundError.
         """
-        if name in self.children and isinstance(self.children[name], FileNode):
+        if name in self.children and self.children[name].KIND == 'f':
             deleted_node = self.children[name]
             del self.children[name]
             return deleted_node
         else:
             raise FileNotFoundError(f"File {name} not found")
 
-    def rename_directory(self, old_name: str, new_name: str) -> List[ list[int, int] ]:
+    def rename_directory(self, old_name: str, new_name: str) -> List[List[str]]:
         """
         Renames the subdirectory with the given old name to the new name if it exists. If the directory doesn't exist, raises a FileNotFoundError.
+        Returns the [old_id, new_id] pairs of every file below it (file IDs are derived from the path).
         """
-        if old_name in self.children and isinstance(self.children[old_name], DirectoryNode):
+        if old_name in self.children and self.children[old_name].KIND == 'd':
+            new_name = sys.intern(new_name)   # Child names are interned (see FileSystem._validate_and_split_path)
             self.children[old_name].name = new_name
             self.children[new_name] = self.children.pop(old_name)
             return self._rename_directory_helper(new_name, self.children[new_name])
         else:
             raise FileNotFoundError(f"Directory {old_name} not found")
     
-    def _rename_directory_helper(self, new_name, node: 'DirectoryNode', depth = 0) -> List[ list[int, int] ]:
-        ids: List[ list[int, int] ] = []
-        for child in node.children.values():
-            if isinstance(child, FileNode):
-                path = child.file_path  # /.../old_dir_name/file.ext
-                parts = list(path.parts)
-                parts[-(2 + depth)] = new_name
-                child.file_path = Path(*parts)
-                old_id = child.file_id
-                new_id = child.generate_file_id()
-                ids.append([old_id, new_id])
-            elif isinstance(child, DirectoryNode):
-                # Recurse into subdirectories
-                ids.extend(self._collect_file_ids(new_name, child, depth + 1))
+    def _rename_directory_helper(self, new_name, node: 'DirectoryNode', depth = 0) -> List[List[str]]:
+        """
+        Iteratively updates the path & file ID of every file below the renamed directory.
+        The new path of a directory is worked out once (from its first file, or from its parent),
+        its files only join their name onto it.
+        """
+        ids: List[List[str]] = []
+        stack: List[tuple['DirectoryNode', int, Path]] = [(node, depth, None)]
+        while stack:
+            node, depth, dir_path = stack.pop()
+            subdirs: List['DirectoryNode'] = []
+            for child in node.children.values():
+                if child.KIND == 'f':
+                    if dir_path is None:
+                        parts = list(child.file_path.parts)  # /.../old_dir_name/.../file.ext
+                        parts[-(2 + depth)] = new_name
+                        dir_path = Path(*parts[:-1])
+                    child.file_path = dir_path / child.file_path.name
+                    old_id = child.file_id
+                    child.file_id = child.generate_file_id()
+                    ids.append([old_id, child.file_id])
+                elif child.KIND == 'd':
+                    subdirs.append(child)
+            for subdir in subdirs:
+                stack.append((subdir, depth + 1, None if dir_path is None else dir_path / subdir.name))
         return ids
 
     def rename_file(self, old_name: str, new_name: str) -> FileNode:
         """
         Renames the file with the given old name to the new name, both in memory and on disk. If the file doesn't exist, raises a FileNotFoundError.
         """
-        if old_name in self.children and isinstance(self.children[old_name], FileNode):
+        if old_name in self.children and self.children[old_name].KIND == 'f':
+            new_name = sys.intern(new_name)   # Child names are interned (see FileSystem._validate_and_split_path)
             self.children[old_name].rename(new_name)
             self.children[new_name] = self.children[old_name]
             del self.children[old_name]
@@ -165,7 +194,7 @@ class DirectoryNode:
         # [1:-1], because this is a abs path, ignore the root "/"
         for i, part in enumerate(path[1:]):
             t = current_dir.children.get(part)
-            if t and (isinstance(current_dir.children[part], FileNode)):
+            if t and (current_dir.children[part].KIND == 'f'):
                 break
             if part in current_dir.children.keys():
                 current_dir = current_dir.children[part]
@@ -173,7 +202,7 @@ class DirectoryNode:
                 raise FileNotFoundError(f"Directory {part} not found in path.")
         
         file_name = path[-1]
-        if file_name in current_dir.children and isinstance(current_dir.children[file_name], FileNode):
+        if file_name in current_dir.children and current_dir.children[file_name].KIND == 'f':
             return current_dir.children[file_name]
         else:
             raise FileNotFoundError(f"File {file_name} not found in path.")
@@ -182,4 +211,5 @@ class DirectoryNode:
         """
         Returns a list of names of all files and directories directly contained within the current directory.
         """
-        return [child.name for child in self.children.values()]
\ No newline at end of file
+        # Children are keyed by their name, no need to touch the nodes themselves
+        return list(self.children)
\ No newline at end of file
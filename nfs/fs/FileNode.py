@@ -23,11 +23,17 @@ __version__         = "1.0.0"
 __maintainer__      = "JUN WEI WANG"
 __email__           = "wjw_03@outlook.com"
 
+import copyreg
 import hashlib
+import pickle
 import time
 from pathlib import Path
 
 class FileNode:
+    KIND = 'f'    # Node type tag, cheaper to check than isinstance() in tree walks
+    _pickle_cache: tuple = None     # (state, pickled bytes) of the last pickled() call
+    _ctime_cache: tuple = None      # (created_at, modified_at, both formatted) of the last __str__ call
+    
     def __init__(self, name: str, file_path: Path):
         self.name: str = name                   # File name
         self.file_path: Path = file_path        # Virtual file path
@@ -50,8 +56,8 @@ class FileNode:
     def rename(self, new_name: str):
         """Rename the file and update the file metadata"""
         self.name = new_name
+        self.file_path = self.file_path.with_name(new_name)
         self.file_id = self.generate_file_id()
-        self.file_path = Path.joinpath(self.file_path.parent, new_name)
         self.modified_at = time.time()
     
     def move(self, path: Path) -> 'FileNode':
@@ -61,31 +67,61 @@ class FileNode:
         
         self.file_path = path
         self.file_id = self.generate_file_id()
-        self.file_path = Path.joinpath(self.file_path.parent, self.file_path.name)
         self.modified_at = time.time()
 
     def __str__(self):
-        return f"File: {self.name}\nSize: {self.size}\nPath: {self.file_path}\nFile ID: {self.file_id}\nCreated: {time.ctime(self.created_at)}\nModified: {time.ctime(self.modified_at)}"
+        # The timestamps are formatted once per value (they only change when the file is modified)
+        cache = self._ctime_cache
+        if cache is None or cache[0] != self.created_at or cache[1] != self.modified_at:
+            cache = self._ctime_cache = (
+                self.created_at, self.modified_at, time.ctime(self.created_at), time.ctime(self.modified_at)
+            )
+        return "".join((
+            "File: ", self.name,
+            "\nSize: ", str(self.size),
+            "\nPath: ", str(self.file_path),
+            "\nFile ID: ", self.file_id,
+            "\nCreated: ", cache[2],
+            "\nModified: ", cache[3]
+        ))
     
     def __repr__(self):
-        return f"FileNode(name={self.name}, file_id={self.file_id}, file_path={self.file_path}, created_at={self.created_at}, modified_at={self.modified_at})"
+        return "FileNode(name=%s, file_id=%s, file_path=%s, created_at=%s, modified_at=%s)" % (
+            self.name, self.file_id, self.file_path, self.created_at, self.modified_at
+        )
     
+    def _state(self) -> tuple:
+        return (self.name, str(self.file_path), self.file_id, self.size, self.created_at, self.modified_at)
+
+    def pickled(self) -> bytes:
+        """
+        Returns the node pickled (protocol 5), memoized: the same node is sent in several packets,
+        it is only pickled again once one of its attributes has changed.
+        """
+        state = self._state()
+        cache = self._pickle_cache
+        if cache is None or cache[0] != state:
+            cache = self._pickle_cache = (state, pickle.dumps(self, protocol=5))
+        return cache[1]
+
     # Serialization method (pickling)
-    def __getstate__(self):
+    def __reduce__(self):
         """
-        This method is called when pickling the object. 
-        It returns the object's state as a dictionary.
+        Pickled as a flat tuple of the attributes, no __dict__ copy.
+        Unpickling goes through __new__ + __setstate__, so __init__ (and generate_file_id) is skipped.
+        The path travels as a string, a PosixPath cannot be instantiated on a Windows client (and vice versa).
         """
-        state = self.__dict__.copy()
-        # If file_path is a Path object, convert it to a string for serialization
-        state['file_path'] = str(self.file_path)
-        return state
+        return (
+            copyreg.__newobj__,
+            (self.__class__,),
+            self._state()
+        )
 
     # Deserialization method (unpickling)
     def __setstate__(self, state):
         """
-        This method is called when unpickling the object. 
-        It restores the object's state from the dictionary.
+        Restores the attributes from the tuple built by __reduce__.
         """
-        state['file_path'] = Path(state['file_path'])  # Convert file_path back to a Path object
-        self.__dict__.update(state)
\ No newline at end of file
+        self.name, file_path, self.file_id, self.size, self.created_at, self.modified_at = state
+        # Convert file_path back to a Path object (FileSystem hands in an already built one when loading)
+        self.file_path = file_path if isinstance(file_path, Path) else Path(file_path)
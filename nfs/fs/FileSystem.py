@@ -25,24 +25,79 @@ __maintainer__      = "JUN WEI WANG"
 __email__           = "wjw_03@outlook.com"
 
 import threading
+import itertools
 import os
+import sys
 import time
 import json
+from contextlib import contextmanager
 from pathlib import Path
-from typing import List, Dict
+from typing import BinaryIO, List, Dict, Optional
 
 from .FileNode import FileNode
 from .DirectoryNode import DirectoryNode
 
+# Snapshot records are (de)serialized with orjson when available, the stdlib otherwise
+try:
+    import orjson
+
+    def _dump_line(record: Dict) -> bytes:
+        return orjson.dumps(record, option=orjson.OPT_APPEND_NEWLINE)
+
+    _load_line = orjson.loads
+except ImportError:
+    def _dump_line(record: Dict) -> bytes:
+        return json.dumps(record).encode('utf-8') + b"\n"
+
+    _load_line = json.loads
+
+class ShardedLock:
+    '''
+    Reader-writer lock made of one lock per CPU.
+    Readers only take the lock of their own shard (assigned per thread), so they do not contend with each other,
+    writers (`with lock:`) take every shard, in order, which excludes all readers and other writers.
+    '''
+    
+    def __init__(self, shards: int = None):
+        self._shards: List[threading.Lock] = [threading.Lock() for _ in range(shards or os.cpu_count() or 1)]
+        self._local = threading.local()
+        self._next = itertools.count()
+    
+    def _read_shard(self) -> threading.Lock:
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = self._local.shard = self._shards[next(self._next) % len(self._shards)]
+        return shard
+    
+    @contextmanager
+    def read(self):
+        with self._read_shard():
+            yield
+    
+    def __enter__(self):
+        for shard in self._shards:
+            shard.acquire()
+        return self
+    
+    def __exit__(self, *exc):
+        for shard in reversed(self._shards):
+            shard.release()
+
 class FileSystem:
     def __init__(self, root_name: str = "/", base_data_folder: str = "storage"):
         """
         Initializes the virtual file system with the specified root directory and a locking mechanism to handle race conditions.
         """
         self.base_data_folder = base_data_folder
+        # On-disk locations are built by string concatenation onto this prefix, no Path parsing per I/O
+        self._base: str = os.fspath(base_data_folder) + os.sep
         self.root = DirectoryNode(root_name)
         os.makedirs(base_data_folder, exist_ok=True)
-        self.lock = threading.Lock()  # Thread lock initialization
+        self.lock = ShardedLock()  # `with self.lock` for mutations, `with self.lock.read()` for lookups
+        # Absolute POSIX path -> FileNode, lookups skip walking the tree (kept in sync by every mutation)
+        self._path_index: Dict[str, FileNode] = {}
+        # Set by every mutation, cleared by save() so unchanged trees are not written out again
+        self._dirty = False
 
     '''
     Base methods
@@ -54,31 +109,30 @@ class FileSystem:
         - Automatically creates folders recursively
         - If file_node is not None, update the file found with the data
         '''
+        if file_node is None:
+            # Usually the file exists already, one index hit under the shared lock (no tree walk)
+            with self.lock.read():
+                file_to_open = self._find_file(file_path)
+            if file_to_open is not None:
+                return file_to_open
+        
         parts = self._validate_and_split_path(file_path)
-        current_dir = self.root
-        t_path = ""
-        for part in parts[1:-1]:
-            try:
-                t_path += f"/{part}"
-                with self.lock:
-                    current_dir = self._traverse_directory(current_dir, part)
-            except FileNotFoundError as e:
-                # Directory DNE, then create one
-                current_dir = self.create_directory(Path(t_path).as_posix())
-        # Check if file exists
-        file_to_open: FileNode = None
         with self.lock:
-            file_to_open = current_dir.children.get(parts[-1])
-        
-        # If the file doesn't exist, create the folders and the file
-        if not file_to_open:
-            # Create a new file node
-            file_to_open = self.create_file(file_path)
-        
-        if file_to_open and file_node:
-            file_to_open = file_node
-            with self.lock:
+            # Missing directories are created on the way down
+            current_dir = self._descend(parts, create_missing=True)
+            
+            # Look the file up, or create it if it doesn't exist
+            if not isinstance(file_path, Path):
+                file_path = Path(file_path)
+            file_to_open, created = current_dir.get_or_create_file(parts[-1], file_path)
+            if created:
+                self._store_file(parts, file_to_open)
+            
+            if file_to_open and file_node:
+                file_to_open = file_node
                 current_dir.mutate_file(parts[-1], file_to_open)
+                self._path_index[self._index_key(parts)] = file_to_open
+                self._dirty = True
         
         return file_to_open
 
@@ -88,28 +142,25 @@ class FileSystem:
             file = t.file_path
         
         parts = self._validate_and_split_path(file)
-        current_dir = self.root
         
         with self.lock:
-            for part in parts[1:-1]:
-                try:
-                    current_dir = self._traverse_directory(current_dir, part)
-                except FileNotFoundError as e:
-                    raise e
+            current_dir = self._descend(parts)
 
-        # Attempt to find the file to delete
-        file_to_delete= current_dir.children.get(parts[-1])
+            # Attempt to find the file to delete
+            file_to_delete = current_dir.children.get(parts[-1])
 
-        if not file_to_delete or not isinstance(file_to_delete, FileNode):
-            raise FileNotFoundError(f"File {file} not found")
+            if not file_to_delete or not file_to_delete.KIND == 'f':
+                raise FileNotFoundError(f"File {file} not found")
 
-        # Ensure the file exists before deletion
-        file_path_to_delete = Path(self.base_data_folder, file_to_delete.file_id)
-        if file_path_to_delete.exists():
-            os.remove(file_path_to_delete)  # Delete the file from the disk
-        
-        with self.lock:
+            # Delete the file from the disk (if it is there)
+            try:
+                os.remove(self._disk_path(file_to_delete.file_id))
+            except FileNotFoundError:
+                pass
+            
             # Finally, delete the file from the tree
+            self._path_index.pop(self._index_key(parts), None)
+            self._dirty = True
             return current_dir.delete_file(parts[-1])
     
     def mutate(self, file: str, new_file_node: FileNode) -> FileNode:
@@ -121,25 +172,20 @@ class FileSystem:
             file = t.file_path
         
         parts = self._validate_and_split_path(file)
-        current_dir = self.root
-        
-        with self.lock:
-            for part in parts[1:-1]:
-                try:
-                    current_dir = self._traverse_directory(current_dir, part)
-                except FileNotFoundError as e:
-                    raise e
         
         with self.lock:
+            current_dir = self._descend(parts)
             file_to_mutate = current_dir.children.get(parts[-1])
             
-            if not file_to_mutate or not isinstance(file_to_mutate, FileNode):
+            if not file_to_mutate or not file_to_mutate.KIND == 'f':
                 raise FileNotFoundError(f"File {file} not found")
         
             # file_to_mutate.modified_at = time.time()  # Update the modification time
             new_file_node.modified_at = time.time()
             
             current_dir.mutate_file(parts[-1], new_file_node)
+            self._path_index[self._index_key(parts)] = new_file_node
+            self._dirty = True
             return new_file_node
     
     '''
@@ -147,141 +193,147 @@ class FileSystem:
     '''
     
     def create_directory(self, path: str):
+        parts = self._validate_and_split_path(path)
         with self.lock:  # Locking the critical section
-            parts = self._validate_and_split_path(path)
-            current_dir = self.root
-            for part in parts[:-1]:
-                current_dir = self._traverse_directory(current_dir, part)
-            return current_dir.create_directory(parts[-1])
+            current_dir = self._descend(parts)
+            directory = current_dir.create_directory(parts[-1])
+            self._dirty = True
+            return directory
 
     def create_file(self, path, content: str = "") -> FileNode:
+        parts = self._validate_and_split_path(path)
         with self.lock:  # Locking the critical section
-            parts = self._validate_and_split_path(path)
-            current_dir = self.root
-            for part in parts[1:-1]:
-                current_dir = self._traverse_directory(current_dir, part)
-            
-            if not isinstance(path, Path):
-                path = Path(path)
-            
-            # Create the file in the directory
-            new_file = current_dir.create_file(parts[-1], path)
-            
-            # Ensure the file is saved to disk (if required by your file system)
-            file_path = Path(self.base_data_folder, new_file.file_id)
-            file_path.parent.mkdir(parents=True, exist_ok=True)  # Ensure directory exists
-            with open(file_path, 'w') as f:
-                new_file.size = f.write(content)
-
-            return new_file
+            current_dir = self._descend(parts)
+            return self._create_file(current_dir, parts, path, content)
 
     def delete_directory(self, path: str):
+        parts = self._validate_and_split_path(path)
         with self.lock:  # Locking the critical section
-            parts = self._validate_and_split_path(path)
-            current_dir = self.root
-
-            i = 0
-            for part in parts[1:-1]:
-                i = i + 1
-                current_dir = self._traverse_directory(current_dir, part)
-
-            if i < len(parts[:-1]) - 1:
-                raise FileNotFoundError(f"Directory {part} not found in path.")
+            current_dir = self._descend(parts)
             
             if not (len(current_dir.children[parts[-1]].children) == 0):
                 raise EnvironmentError(f"Directory {path} is not empty.")
             
             current_dir.delete_directory(parts[-1])
+            self._dirty = True
 
     def delete_file(self, path: str):
+        parts = self._validate_and_split_path(path)
         with self.lock:  # Locking the critical section
-            parts = self._validate_and_split_path(path)
-
-            current_dir = self.root
-            for part in parts[:-1]:
-                current_dir = self._traverse_directory(current_dir, part)
+            current_dir = self._descend(parts)
 
             # Attempt to delete the file from the file system
             file_to_delete = current_dir.children.get(parts[-1])
 
-            if not file_to_delete or not isinstance(file_to_delete, FileNode):
+            if not file_to_delete or not file_to_delete.KIND == 'f':
                 raise FileNotFoundError(f"File {path} not found")
 
-            # Ensure the file exists before deletion
-            file_path = Path(self.base_data_folder, file_to_delete.file_id)
-            if file_path.exists():
-                os.remove(file_path)  # Remove the file from the system
+            # Remove the file from the system (if it is there)
+            try:
+                os.remove(self._disk_path(file_to_delete.file_id))
+            except FileNotFoundError:
+                pass
 
             current_dir.delete_file(parts[-1])
+            self._path_index.pop(self._index_key(parts), None)
+            self._dirty = True
 
     def rename_directory(self, old_path: str, new_name: str):
+        parts = self._validate_and_split_path(old_path)
         with self.lock:  # Locking the critical section
-            parts = self._validate_and_split_path(old_path)
-            current_dir = self.root
-            for part in parts[:-1]:
-                current_dir = self._traverse_directory(current_dir, part)
+            current_dir = self._descend(parts)
             
-            current_dir.rename_directory(parts[-1], new_name)
+            ids = current_dir.rename_directory(parts[-1], new_name)
+            
+            # File IDs are derived from the path, move the contents along
+            moved = []
+            try:
+                for old_id, new_id in ids:
+                    os.replace(self._disk_path(old_id), self._disk_path(new_id))
+                    moved.append((old_id, new_id))
+            except OSError:
+                # Undo the moves & the rename, the index was not re-keyed yet so everything is back to the old names
+                for old_id, new_id in reversed(moved):
+                    os.replace(self._disk_path(new_id), self._disk_path(old_id))
+                current_dir.rename_directory(new_name, parts[-1])
+                raise
+            
+            # Re-key every file below the renamed directory
+            old_prefix = self._index_key(parts) + "/"
+            new_prefix = self._index_key(parts[:-1] + [new_name]) + "/"
+            for key in [key for key in self._path_index if key.startswith(old_prefix)]:
+                self._path_index[new_prefix + key[len(old_prefix):]] = self._path_index.pop(key)
+            self._dirty = True
 
     def rename_file(self, old_path: str, new_name: str):
+        parts = self._validate_and_split_path(old_path)
         with self.lock:  # Locking the critical section
-            parts = self._validate_and_split_path(old_path)
-            current_dir = self.root
-            for part in parts[:-1]:
-                current_dir = self._traverse_directory(current_dir, part)
+            current_dir = self._descend(parts)
             
-            old_id = current_dir.get_file(parts[1:]).file_id
+            file_to_rename = current_dir.children.get(parts[-1])
+            if not file_to_rename or not file_to_rename.KIND == 'f':
+                raise FileNotFoundError(f"File {old_path} not found")
+            
+            old_id = file_to_rename.file_id
             file = current_dir.rename_file(parts[-1], new_name)
+            self._path_index.pop(self._index_key(parts), None)
+            self._path_index[self._index_key(parts[:-1] + [new_name])] = file
             
-            os.rename(
-                Path(self.base_data_folder, old_id),
-                Path(self.base_data_folder, file.file_id)
-            )
+            os.replace(self._disk_path(old_id), self._disk_path(file.file_id))
+            self._dirty = True
 
     def get_file_node(self, abs_path: str) -> FileNode:
-        with self.lock:  # Locking the critical section
-            parts = self._validate_and_split_path(abs_path)
-            try:
-                file = self.root.get_file(parts)
-                return file
-            except FileNotFoundError:
-                raise FileNotFoundError(f"File {abs_path} not found")
+        with self.lock.read():  # Shared with other readers
+            return self._lookup_file(abs_path)
     
     def get_file(self, abs_path: str) -> bytes:
-        with self.lock:  # Locking the critical section
-            parts = self._validate_and_split_path(abs_path)
-            file_node: FileNode = None
-            try:
-                file_node = self.root.get_file(parts)
-            except FileNotFoundError:
-                raise FileNotFoundError(f"File {abs_path} not found")
+        with self.lock.read():  # Shared with other readers
+            file_node: FileNode = self._lookup_file(abs_path)
             
-            file_path = Path(self.base_data_folder, file_node.file_id)
+            file_path = self._disk_path(file_node.file_id)
             
             try:
-                with open(file_path, 'rb') as f:
-                    return f.read()
+                fd = os.open(file_path, os.O_RDONLY)
             except FileNotFoundError:
                 raise FileNotFoundError(f"File {abs_path} not found")
+            
+            # Sized reads straight from the fd, no buffered reader in between
+            try:
+                chunks: List[bytes] = []
+                remaining = os.fstat(fd).st_size
+                while remaining > 0 and (chunk := os.read(fd, remaining)):
+                    chunks.append(chunk)
+                    remaining -= len(chunk)
+                return b"".join(chunks)
+            finally:
+                os.close(fd)
+    
+    def get_file_location(self, abs_path: str) -> Path:
+        """Returns where the contents of the file at abs_path are stored on disk (for streamed I/O)"""
+        with self.lock.read():  # Shared with other readers
+            file_node = self._lookup_file(abs_path)
+            
+            return Path(self.base_data_folder, file_node.file_id)
     
     def save_file(self, abs_path: str, data: bytes) -> int:
         with self.lock:
             # Validate the path and locate the FileNode
-            parts = self._validate_and_split_path(abs_path)
-            try:
-                file_node = self.root.get_file(parts)
-            except FileNotFoundError:
-                raise FileNotFoundError(f"File {abs_path} not found")
+            file_node = self._lookup_file(abs_path)
 
             # Compute the on-disk location from the file_id
-            file_path = Path(self.base_data_folder) / file_node.file_id
+            file_path = self._disk_path(file_node.file_id)
 
-            # Write the data
+            # Write the data (unbuffered, straight from the caller's buffer) next to the file,
+            # then swap it in, the previous contents stay intact if the write fails
+            staging = f"{file_path}.tmp"
             try:
-                with open(file_path, 'wb') as f:
-                    bytes_written = f.write(data)
-                    f.flush()
-                    return bytes_written
+                fd = os.open(staging, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+                try:
+                    bytes_written = self._write_all(fd, data)
+                finally:
+                    os.close(fd)
+                os.replace(staging, file_path)
+                return bytes_written
             except IOError as e:
                 raise IOError(f"Failed to write to {abs_path}: {e}")
             except Exception as e:
@@ -289,47 +341,173 @@ class FileSystem:
 
     def save(self, file_path: str):
         with self.lock:  # Locking the critical section
-            with open(file_path, 'w') as f:
-                json.dump(self._serialize(self.root), f)
+            # Written next to the snapshot & swapped in, an interrupted save leaves the previous one intact
+            staging = f"{os.fspath(file_path)}.tmp"
+            with open(staging, 'wb') as f:
+                self._serialize(self.root, f)
+            os.replace(staging, file_path)
+            self._dirty = False
 
     def load(self, file_path: str):
         with self.lock:  # Locking the critical section
-            with open(file_path, 'r') as f:
-                data = json.load(f)
-                self.root = self._deserialize(data)
-
-    def _serialize(self, node) -> Dict:
-        """Serialize the file system into a dictionary format"""
-        if isinstance(node, DirectoryNode):
-            return {"type": "directory", "name": node.name, "children": {k: self._serialize(v) for k, v in node.children.items()}}
-        elif isinstance(node, FileNode):
-            return {"type": "file", "name": node.name, "size": node.size, "file_path": node.file_path.as_posix(), "file_id": node.file_id, "created_at": node.created_at, "modified_at": node.modified_at}
-        else:
-            raise TypeError("Unknown node type")
-
-    def _deserialize(self, data: Dict) -> DirectoryNode:
-        """Deserialize the file system from a dictionary format"""
+            with open(file_path, 'rb') as f:
+                first = _load_line(f.readline())
+                if 'children' in first:
+                    # Older snapshot, the whole tree as one nested JSON document
+                    self.root = self._deserialize_tree(first)
+                    self._rebuild_index()
+                else:
+                    self._deserialize(first, f)
+            self._dirty = False
+
+    def _serialize(self, root: DirectoryNode, f: BinaryIO):
+        """
+        Writes the file system as NDJSON, one record per node, walking the tree iteratively (depth first).
+        Directories are numbered in the order they are written, every record refers to its parent directory by that number,
+        so a parent always comes before its children.
+        """
+        next_id = 0
+        stack = [(root, -1)]
+        while stack:
+            node, parent = stack.pop()
+            dir_id = next_id
+            next_id += 1
+            f.write(_dump_line({"type": "directory", "id": dir_id, "parent": parent, "name": node.name}))
+            for child in node.children.values():
+                if child.KIND == 'd':
+                    stack.append((child, dir_id))
+                else:
+                    f.write(_dump_line({"type": "file", "parent": dir_id, "name": child.name, "size": child.size, "file_path": child.file_path.as_posix(), "file_id": child.file_id, "created_at": child.created_at, "modified_at": child.modified_at}))
+
+    def _deserialize(self, first: Dict, f: BinaryIO):
+        """Rebuilds the file system (and the path index) from the NDJSON records written by _serialize, in one pass"""
+        self.root = DirectoryNode(first['name'])
+        self._path_index = {}
+        dirs: List[DirectoryNode] = [self.root]   # Indexed by directory number
+        prefixes: List[str] = [""]               # Index key prefix of each directory
+        dir_paths: List[Path] = [Path("/")]      # Parsed path of each directory, shared by the paths of its files
+        for line in f:
+            data = _load_line(line)
+            parent = data['parent']
+            if data['type'] == 'directory':
+                dir_node = DirectoryNode(sys.intern(data['name']))
+                dirs[parent].children[dir_node.name] = dir_node
+                dirs.append(dir_node)
+                prefixes.append(f"{prefixes[parent]}/{dir_node.name}")
+                dir_paths.append(dir_paths[parent] / dir_node.name)
+            elif data['type'] == 'file':
+                # Extend the directory's Path instead of parsing the whole stored path again
+                file_node = self._restore_file(data, dir_paths[parent] / data['name'])
+                dirs[parent].children[file_node.name] = file_node
+                self._path_index[f"{prefixes[parent]}/{file_node.name}"] = file_node
+            else:
+                raise TypeError("Unknown node type")
+
+    def _deserialize_tree(self, data: Dict) -> DirectoryNode:
+        """Deserialize the file system from the older nested dictionary format"""
         if data['type'] == 'directory':
             dir_node = DirectoryNode(data['name'])
             for child_name, child_data in data['children'].items():
-                dir_node.children[child_name] = self._deserialize(child_data)
+                dir_node.children[child_name] = self._deserialize_tree(child_data)
             return dir_node
         elif data['type'] == 'file':
-            return FileNode(data['name'], Path(data['file_path']))
+            return self._restore_file(data)
         else:
             raise TypeError("Unknown node type")
     
+    def _restore_file(self, data: Dict, file_path: Path = None) -> FileNode:
+        """Rebuilds a FileNode from its snapshot record, the stored file_id is reused (no re-hashing in __init__)"""
+        file_node = FileNode.__new__(FileNode)
+        file_node.__setstate__((sys.intern(data['name']), data['file_path'] if file_path is None else file_path, data['file_id'], data['size'], data['created_at'], data['modified_at']))
+        return file_node
+    
+    def _rebuild_index(self):
+        """Rebuild the path index from the tree (e.g. after loading)"""
+        self._path_index = {}
+        stack = [("", self.root)]
+        while stack:
+            prefix, dir_node = stack.pop()
+            for name, child in dir_node.children.items():
+                if child.KIND == 'd':
+                    stack.append((f"{prefix}/{name}", child))
+                else:
+                    self._path_index[f"{prefix}/{name}"] = child
+    
+    def _disk_path(self, file_id: str) -> str:
+        """Where the contents of the file with file_id are stored on disk"""
+        return self._base + file_id
+    
+    def _index_key(self, parts: List[str]) -> str:
+        """Path index key of a split absolute path (['/', 'dir1', 'file.txt'] -> '/dir1/file.txt')"""
+        return "/" + "/".join(parts[1:])
+    
+    def _lookup_file(self, abs_path: str) -> FileNode:
+        """Find the FileNode at abs_path through the path index (caller holds the lock)"""
+        file_node = self._find_file(abs_path)
+        if file_node is None:
+            raise FileNotFoundError(f"File {abs_path} not found")
+        return file_node
+    
+    def _find_file(self, abs_path: str) -> Optional[FileNode]:
+        """Same as _lookup_file, None if there is no such file"""
+        path = os.fspath(abs_path)
+        if path.startswith("/") and not path.endswith("/") and "//" not in path and "/." not in path:
+            # Already normalized (the usual case, paths come from FileNode.file_path), it is its own index key
+            return self._path_index.get(path)
+        return self._path_index.get(self._index_key(self._validate_and_split_path(path)))
+    
     def _validate_and_split_path(self, path: str) -> List[str]:
-        p = Path(path)
-        if not p.is_absolute():
+        """Splits an absolute POSIX path into ['/', <part>, ...], plain string splitting (no Path parsing)"""
+        path = os.fspath(path)
+        if not path.startswith("/"):
             raise ValueError(f"Path must be absolute: {path}")
-        return [part for part in p.parts if part]
-
-    def _traverse_directory(self, current_dir: DirectoryNode, part: str) -> DirectoryNode:
-        """Traverse a directory and return the next directory node"""        
-        if current_dir.name == part:
-            return current_dir
-        elif part in current_dir.children and isinstance(current_dir.children[part], DirectoryNode):
-            return current_dir.children[part]
-        else:
-            raise FileNotFoundError(f"Directory {part} not found in path.")
\ No newline at end of file
+        # Interned, so that the children lookups along the path hit on identity (the same names are looked up on every request)
+        return ["/"] + [sys.intern(part) for part in path.split("/") if part and part != "."]
+
+    def _descend(self, parts: List[str], create_missing: bool = False) -> DirectoryNode:
+        """
+        Walks down from the root once and returns the directory holding parts[-1] (caller holds the lock).
+        Missing directories are created on the way if create_missing, otherwise raise a FileNotFoundError.
+        """
+        current_dir = self.root
+        for part in parts[1:-1]:
+            child = current_dir.children.get(part)
+            if child is None and create_missing:
+                child = current_dir.create_directory(part)
+                self._dirty = True
+            elif child is None or not child.KIND == 'd':
+                raise FileNotFoundError(f"Directory {part} not found in path.")
+            current_dir = child
+        return current_dir
+    
+    def _create_file(self, current_dir: DirectoryNode, parts: List[str], path, content: str = "") -> FileNode:
+        """Creates the file parts[-1] in current_dir, indexes it and writes its contents to disk (caller holds the lock)"""
+        if not isinstance(path, Path):
+            path = Path(path)
+        
+        # Create the file in the directory
+        new_file = current_dir.create_file(parts[-1], path)
+        return self._store_file(parts, new_file, content)
+    
+    def _store_file(self, parts: List[str], new_file: FileNode, content: str = "") -> FileNode:
+        """Indexes a newly created file and writes its contents to disk (caller holds the lock)"""
+        self._path_index[self._index_key(parts)] = new_file
+        self._dirty = True
+        
+        # Ensure the file is saved to disk (the data folder itself is created in __init__)
+        fd = os.open(self._disk_path(new_file.file_id), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            # Usually empty (open creates files), then there is nothing to write
+            new_file.size = self._write_all(fd, content.encode('utf-8')) if content else 0
+        finally:
+            os.close(fd)
+
+        return new_file
+    
+    def _write_all(self, fd: int, data: bytes) -> int:
+        """Writes all of data to fd (os.write may write less than asked), returns the number of bytes written"""
+        view = memoryview(data)
+        written = 0
+        while written < len(view):
+            written += os.write(fd, view[written:])
+        return written
@@ -1,8 +1,68 @@
 from pathlib import Path
+from collections import deque
+from typing import Deque, Iterator, Tuple
+import functools
+import io
 import json
+import os
+import socket
+import struct
+import sys
 import pickle
 
 from nfs.fs import FileNode
+from nfs.constants import CHUNK_SIZE, SOCKET_BUFFER_SIZE
+
+# Packet headers are (de)serialized in C when possible: msgspec (one pre-built encoder/decoder pair),
+# then orjson, falling back to the stdlib when neither is installed
+try:
+    import msgspec
+
+    _header_encoder = msgspec.json.Encoder()
+    _header_decoder = msgspec.json.Decoder()
+    json_dumps = _header_encoder.encode
+    json_loads = _header_decoder.decode
+except ImportError:
+    try:
+        import orjson
+
+        json_dumps = orjson.dumps
+        json_loads = orjson.loads
+    except ImportError:
+        def json_dumps(obj) -> bytes:
+            return json.dumps(obj).encode('utf-8')
+
+        def json_loads(data):
+            # The stdlib parser does not take memoryviews
+            return json.loads(bytes(data))
+
+'''
+Packet framing
+
+    <header length: uint32, big-endian><JSON header><blob>
+
+The JSON header carries the small fields (action, message, OK, ...), the blob carries
+the raw pickled FileNode, no hex/JSON escaping of the payload.
+'''
+
+HEADER_LEN = struct.Struct('>I')
+
+def pack(header: dict, blob: bytes = b"") -> bytes:
+    encoded = json_dumps(header)
+    return b"".join((HEADER_LEN.pack(len(encoded)), encoded, blob))
+
+def unpack(frame: bytes) -> Tuple[dict, memoryview]:
+    view = memoryview(frame)
+    end = HEADER_LEN.size + HEADER_LEN.unpack_from(view)[0]
+    return json_loads(view[HEADER_LEN.size:end]), view[end:]
+
+def dump_node(file_node: FileNode) -> bytes:
+    if file_node is None:
+        return pickle.dumps(None, protocol=5)
+    return file_node.pickled()
+
+def load_node(blob: memoryview) -> FileNode:
+    return pickle.loads(blob)
 
 class Template:
     def __init__(self):
@@ -26,9 +86,9 @@ class OpenRequest:
         self.action: str = "open"
         self.file_path: Path = None
     
-    def encode(self, file_path: Path) -> str:
+    def encode(self, file_path: Path) -> bytes:
         self.file_path = file_path
-        data: str = json.dumps(
+        data: bytes = pack(
             {
                 "action": "open",
                 "file_path": self.file_path.as_posix(),
@@ -37,8 +97,10 @@ class OpenRequest:
         return data
         
     def decode(self, bytes: bytes):
-        decoded = bytes.decode('utf-8')
-        obj = json.loads(decoded)
+        self.decode_parts(*unpack(bytes))
+    
+    def decode_parts(self, obj: dict, blob: memoryview):
+        '''decode() for a frame that was already unpacked (the server reads the header to dispatch)'''
         try:
             self.action = obj['action']
             self.file_path = Path(obj['file_path'])
@@ -49,8 +111,8 @@ class OpenResponse:
     '''
     {
       "message": <string>,
-      "file_node": <bytes>
-    }
+      "OK": <bool>
+    } + <FileNode>
     '''
   
     def __init__(self):
@@ -58,23 +120,22 @@ class OpenResponse:
         self.OK: bool = False
         self.file_node: FileNode = None
     
-    def encode(self, msg: str = "", OK: bool = False, file_node: FileNode = None) -> str:
-        data: str = json.dumps(
+    def encode(self, msg: str = "", OK: bool = False, file_node: FileNode = None) -> bytes:
+        data: bytes = pack(
             {
                 "message": msg,
-                "OK": OK,
-                "file_node": pickle.dumps(file_node).hex()
-            }
+                "OK": OK
+            },
+            dump_node(file_node)
         )
         return data
     
     def decode(self, bytes: bytes):
-        decoded = bytes.decode('utf-8')
-        obj = json.loads(decoded)
+        obj, blob = unpack(bytes)
         try:
             self.message = obj['message']
             self.OK = obj['OK']
-            self.file_node: FileNode = pickle.loads(bytes.fromhex(obj['file_node']))
+            self.file_node: FileNode = load_node(blob)
         except IndexError as e:
             print("Open response decoding error")
 
@@ -83,29 +144,33 @@ class CloseRequest:
         '''
         {
             "action": "close",
-            "file_node": "<FileNode>"
-        }
+            "upload": <str> (token of the parallel upload to swap in, None if the file was written whole)
+        } + <FileNode>
         '''
         self.action: str = "close"
         self.message: str = ""
         self.OK: bool = False
         self.file_node: FileNode = None
+        self.upload: str = None
     
-    def encode(self, file_node: FileNode = None) -> str:
-        data: str = json.dumps(
+    def encode(self, file_node: FileNode = None, upload: str = None) -> bytes:
+        data: bytes = pack(
             {
                 "action": "close",
-                "file_node": pickle.dumps(file_node).hex()
-            }
+                "upload": upload
+            },
+            dump_node(file_node)
         )
         return data
     
     def decode(self, bytes: bytes):
-        decoded = bytes.decode('utf-8')
-        obj = json.loads(decoded)
+        self.decode_parts(*unpack(bytes))
+    
+    def decode_parts(self, obj: dict, blob: memoryview):
         try:
             self.action = obj['action']
-            self.file_node = pickle.loads(bytes.fromhex(obj['file_node']))
+            self.file_node = load_node(blob)
+            self.upload = obj.get('upload')
         except IndexError as e:
             print("Close request decoding error")
 
@@ -118,66 +183,171 @@ class CloseResponse:
         '''
         {
             "message": <string>,
-            "OK": <bool>,
-            "file_node": <bytes>
-        }
+            "OK": <bool>
+        } + <FileNode>
         '''
         self.action: str = "close"
         self.message: str = ""
         self.OK: bool = False
         self.file_node: FileNode = None
     
-    def encode(self, msg: str = "", OK: bool = False, file_node: FileNode = None):
-        data: str = json.dumps(
+    def encode(self, msg: str = "", OK: bool = False, file_node: FileNode = None) -> bytes:
+        data: bytes = pack(
             {
                 "message": msg,
-                "OK": OK,
-                "file_node": pickle.dumps(file_node).hex()
-            }
+                "OK": OK
+            },
+            dump_node(file_node)
         )
         return data
     
     def decode(self, bytes: bytes):
-        decoded = bytes.decode('utf-8')
-        obj = json.loads(decoded)
+        obj, blob = unpack(bytes)
         try:
             self.message = obj['message']
             self.OK = obj['OK']
-            self.file_node: FileNode = pickle.loads(bytes.fromhex(obj['file_node']))
+            self.file_node: FileNode = load_node(blob)
         except IndexError as e:
             print("Close response decoding error")
 
 '''
 Data transfer socket wrappers
+
+The file contents are not embedded in ReadResponse/WriteRequest, they follow the
+header as a separate (fragmented) binary WebSocket message, see iter_file_chunks/recv_file_chunks.
 '''
 
+@functools.lru_cache(maxsize=None)
+def _net_core_limit(name: str) -> int:
+    '''The net.core.<name> sysctl (Linux), 0 where it cannot be read'''
+    try:
+        with open(f"/proc/sys/net/core/{name}") as f:
+            return int(f.read())
+    except (OSError, ValueError):
+        return 0
+
+def set_socket_buffers(websocket, size: int = SOCKET_BUFFER_SIZE):
+    '''
+    Enlarges the kernel send/receive buffers of a (file transfer) connection to size,
+    so that bulk transfers move more bytes per syscall & event loop wake-up.
+    
+    Setting a buffer turns Linux's TCP autotuning off for it (which grows it up to net.ipv4.tcp_{w,r}mem),
+    and the kernel silently caps the value at net.core.{w,r}mem_max (212992 bytes on stock kernels).
+    So a buffer is only set when that limit was raised to at least size, e.g.
+        sysctl -w net.core.rmem_max=4194304 net.core.wmem_max=4194304
+    and the buffer is currently smaller, otherwise autotuning stays in charge.
+    The window scale is negotiated in the handshake, before this runs, so it is not affected either way.
+    '''
+    sock = websocket.transport.get_extra_info('socket')
+    if sock is None:
+        return
+    for option, limit in ((socket.SO_SNDBUF, 'wmem_max'), (socket.SO_RCVBUF, 'rmem_max')):
+        if _net_core_limit(limit) >= size and sock.getsockopt(socket.SOL_SOCKET, option) < size:
+            sock.setsockopt(socket.SOL_SOCKET, option, size)
+
+class BufferPool:
+    '''
+    A few reusable chunk-sized bytearrays for streaming file contents,
+    instead of allocating (and freeing) a new bytes object for every fragment.
+    '''
+    
+    def __init__(self, count: int = 4, size: int = CHUNK_SIZE):
+        self.count: int = count
+        self.size: int = size
+        self._free: Deque[bytearray] = deque(bytearray(size) for _ in range(count))
+    
+    def acquire(self) -> bytearray:
+        # Grow past `count` instead of blocking, extra buffers are dropped on release
+        return self._free.pop() if self._free else bytearray(self.size)
+    
+    def release(self, buf: bytearray):
+        if len(self._free) < self.count:
+            self._free.append(buf)
+
+# Positional reads/writes (the fd's position is not used). Windows has neither os.preadv nor os.pwrite,
+# there they are emulated with a seek followed by a plain read/write, which does move the fd's position
+# (every transfer opens its own fd, so nothing else relies on it)
+if hasattr(os, 'preadv'):
+    def pread_into(fd: int, view: memoryview, offset: int) -> int:
+        return os.preadv(fd, [view], offset)
+else:
+    def pread_into(fd: int, view: memoryview, offset: int) -> int:
+        os.lseek(fd, offset, os.SEEK_SET)
+        with io.FileIO(fd, closefd=False) as f:
+            return f.readinto(view)
+
+if hasattr(os, 'pwrite'):
+    pwrite = os.pwrite
+else:
+    def pwrite(fd: int, view: memoryview, offset: int) -> int:
+        os.lseek(fd, offset, os.SEEK_SET)
+        return os.write(fd, view)
+
+def iter_file_chunks(fd: int, pool: BufferPool, offset: int = 0, length: int = None) -> Iterator[memoryview]:
+    '''
+    Yields the contents of the file open at fd from offset on (at most length bytes, if given) in pool-buffer-sized pieces.
+    Chunks are read with positional reads (pread_into) straight into a pooled buffer.
+    Passing this to websocket.send() sends the file as one fragmented message.
+    Every chunk is a view into the same pooled buffer, it is only valid until the next one is requested.
+    Always yields at least one chunk, an empty file would otherwise send no message at all.
+    '''
+    buf = pool.acquire()
+    view = memoryview(buf)
+    try:
+        remaining = sys.maxsize if length is None else length
+        n = pread_into(fd, view[:min(pool.size, remaining)], offset)
+        yield view[:n]
+        offset += n
+        remaining -= n
+        while remaining > 0 and (n := pread_into(fd, view[:min(pool.size, remaining)], offset)):
+            offset += n
+            remaining -= n
+            yield view[:n]
+    finally:
+        view.release()
+        pool.release(buf)
+
+async def recv_file_chunks(websocket, fd: int, offset: int = 0) -> int:
+    '''
+    Receives a streamed (fragmented) message and writes each fragment to the file open at fd,
+    from offset on, with positional writes (pwrite). Returns the number of bytes written.
+    '''
+    written = 0
+    async for fragment in websocket.recv_streaming(decode=False):
+        view = memoryview(fragment)
+        while view:
+            n = pwrite(fd, view, offset + written)
+            written += n
+            view = view[n:]
+    return written
+
 class ReadRequest:
     def __init__(self):
         '''
         {
             "action": "read",
-            "file_node": <bytes>,
             "seek": <int>, (offset)
             "len": <int>, (bytes to read)
-        }
+        } + <FileNode>
         '''
         self.action: str = "read"
         self.file_node: FileNode = None
     
-    def encode(self, file_node: FileNode = None) -> str:
-        data: str = json.dumps(
+    def encode(self, file_node: FileNode = None) -> bytes:
+        data: bytes = pack(
             {
-                "action": self.action,
-                "file_node": pickle.dumps(file_node).hex()
-            }
+                "action": self.action
+            },
+            dump_node(file_node)
         )
         return data
     
     def decode(self, bytes: bytes):
-        decoded = bytes.decode('utf-8')
-        obj = json.loads(decoded)
+        self.decode_parts(*unpack(bytes))
+    
+    def decode_parts(self, obj: dict, blob: memoryview):
         try:
-            self.file_node = pickle.loads(bytes.fromhex(obj['file_node']))
+            self.file_node = load_node(blob)
         except IndexError as e:
             print("Download request decoding error")
 
@@ -186,35 +356,34 @@ class ReadResponse:
         '''
         {
             "message": <str>,
-            "file_node": <bytes>,
-            "data": <bytes>
-        }
+            "OK": <bool>,
+            "length": <int> (size of the contents that follow)
+        } + <FileNode>
+        The contents are not part of the response, they follow it as a separate (streamed) message.
         '''
         self.message: str = ""
         self.OK = False
         self.file_node: FileNode = None
-        self.data: bytes = None
+        self.length: int = -1
     
-    def encode(self, msg: str = "", OK: bool = False, data: bytes = None) -> str:
-        self.data = data
-        data: str = json.dumps(
+    def encode(self, msg: str = "", OK: bool = False, length: int = -1, file_node: FileNode = None) -> bytes:
+        data: bytes = pack(
             {
-                "message": self.message,
+                "message": msg,
                 "OK": OK,
-                "file_node": pickle.dumps(self.file_node).hex(),
-                "data":  pickle.dumps(self.data).hex(),
-            }
+                "length": length
+            },
+            dump_node(self.file_node if file_node is None else file_node)
         )
         return data
     
     def decode(self, bytes: bytes):
-        decoded = bytes.decode('utf-8')
-        obj = json.loads(decoded)
+        obj, blob = unpack(bytes)
         try:
             self.message = obj['message']
             self.OK = obj['OK']
-            self.file_node = pickle.loads(bytes.fromhex(obj['file_node']))
-            self.data = pickle.loads(bytes.fromhex(obj['data']))
+            self.file_node = load_node(blob)
+            self.length = obj['length']
         except IndexError as e:
             print("Download response decoding error")
 
@@ -223,30 +392,39 @@ class WriteRequest:
         '''
         {
             "action": "write",
-            "file_node": <bytes>,
-            "data": <bytes>
-        }
+            "offset": <int> (None overwrites the whole file, otherwise one range of a parallel upload),
+            "length": <int> (size of the range, None for a whole file),
+            "upload": <str> (token shared by the ranges of one parallel upload, None for a whole file)
+        } + <FileNode>
+        The contents are not part of the request, they follow it as a separate (streamed) message.
         '''
         self.action: str = "write"
         self.file_node: FileNode = None
-        self.data: bytes = None
+        self.offset: int = None
+        self.length: int = None
+        self.upload: str = None
     
-    def encode(self, file_node: FileNode, data: bytes) -> str:
-        data: str = json.dumps(
+    def encode(self, file_node: FileNode, offset: int = None, length: int = None, upload: str = None) -> bytes:
+        data: bytes = pack(
             {
                 "action": self.action,
-                "file_node": pickle.dumps(file_node).hex(),
-                "data": pickle.dumps(data).hex()
-            }
+                "offset": offset,
+                "length": length,
+                "upload": upload
+            },
+            dump_node(file_node)
         )
         return data
     
     def decode(self, bytes: bytes):
-        decoded = bytes.decode('utf-8')
-        obj = json.loads(decoded)
+        self.decode_parts(*unpack(bytes))
+    
+    def decode_parts(self, obj: dict, blob: memoryview):
         try:
-            self.file_node = pickle.loads(bytes.fromhex(obj['file_node']))
-            self.data = pickle.loads(bytes.fromhex(obj['data']))
+            self.file_node = load_node(blob)
+            self.offset = obj.get('offset')
+            self.length = obj.get('length')
+            self.upload = obj.get('upload')
         except IndexError as e:
             print("Upload request decoding error")
 
@@ -256,33 +434,31 @@ class WriteResponse:
         {
             "message": <str>,
             "OK": <bool>,
-            "file_node": <bytes>,
             "bytes_written": <int>
-        }
+        } + <FileNode>
         '''
         self.message: str = ""
         self.OK: bool = False
         self.file_node: FileNode = None
         self.bytes_written: int = -1
     
-    def encode(self, msg: str = "", OK: bool = False, file_node: FileNode = None, bytes_written: int = -1) -> str:
-        data: str = json.dumps(
+    def encode(self, msg: str = "", OK: bool = False, file_node: FileNode = None, bytes_written: int = -1) -> bytes:
+        data: bytes = pack(
             {
                 "message": msg,
                 "OK": OK,
-                "file_node": pickle.dumps(file_node).hex(),
                 "bytes_written": bytes_written
-            }
+            },
+            dump_node(file_node)
         )
         return data
     
     def decode(self, bytes: bytes):
-        decoded = bytes.decode('utf-8')
-        obj = json.loads(decoded)
+        obj, blob = unpack(bytes)
         try:
             self.message = obj["message"]
             self.OK = obj["OK"]
-            self.file_node = pickle.loads(bytes.fromhex(obj['file_node']))
+            self.file_node = load_node(blob)
             self.bytes_written = obj["bytes_written"]
         except IndexError as e:
             print("Write response decoding error")
\ No newline at end of file
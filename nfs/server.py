@@ -1,17 +1,18 @@
 import argparse
 import asyncio
 import websockets
-import json
 import os
 import sys
 import signal
+from typing import Dict, Set, Tuple
 
-from nfs.constants import NFS_SERVER, NFS_PORT, NFS_FS_PORT, PERSIST_DIR
+from nfs.constants import NFS_SERVER, NFS_PORT, NFS_FS_PORT, PERSIST_DIR, CHUNK_SIZE
 from nfs.fs import FileSystem, FileNode
 from nfs.packet import OpenRequest, OpenResponse, \
     CloseRequest, CloseResponse, \
     ReadRequest, ReadResponse, \
-    WriteRequest, WriteResponse
+    WriteRequest, WriteResponse, \
+    BufferPool, unpack, iter_file_chunks, recv_file_chunks, set_socket_buffers
 
 # NFS Server that handles file operations using WebSocket
 class NFSServer:
@@ -24,13 +25,42 @@ class NFSServer:
         if os.path.exists(PERSIST_DIR):
             self.fs.load(PERSIST_DIR)
         
-        # Catching SIGINT (Ctrl+C) to save state before exiting
-        signal.signal(signal.SIGINT, self.handle_exit)
+        # Reusable buffers for streaming file contents to clients
+        self.buffer_pool = BufferPool()
+        
+        # Constant replies, encoded once instead of on every request
+        self._resp_unknown = b"Unknown command.\nType 'help' for available commands."
+        self._resp_unknown_file = b"Unknown file command."
+
+        # The responses' encode() keeps no state, one instance of each serves every request
+        self._open_response = OpenResponse()
+        self._close_response = CloseResponse()
+        self._read_response = ReadResponse()
+        self._write_response = WriteResponse()
+
+        # Parallel (ranged) uploads in progress: upload token -> (on-disk location, file size, {(offset, length), ...} received),
+        # the ranges go to one staging file per upload that is swapped in once a CloseRequest with the same token arrives
+        self._staged_ranges: Dict[str, Tuple[str, int, Set[Tuple[int, int]]]] = {}
+
+        # action -> handler, one dict lookup per request
+        self._dispatch = {
+            "open": self._handle_open,
+            "close": self._handle_close,
+        }
+        self._transfer_dispatch = {
+            "read": self._handle_read,
+            "write": self._handle_write,
+        }
     
     async def start(self):
         # Start both servers
-        text_server = await websockets.serve(self.handle_nfs, self.host, self.port)
-        binary_server = await websockets.serve(self.handle_file, self.host, self.fs_port)
+        # File contents are streamed as fragmented messages, lift the default 1 MiB message cap.
+        # permessage-deflate only burns CPU on (mostly incompressible) file data, disable it.
+        text_server = await websockets.serve(self.handle_nfs, self.host, self.port, compression=None, max_size=None)
+        # The transfer port buffers a whole fragment before pausing the sender (the default is 32 KiB),
+        # the command port keeps the defaults
+        binary_server = await websockets.serve(self.handle_file, self.host, self.fs_port, compression=None, max_size=None,
+                                               write_limit=CHUNK_SIZE)
 
         print(f"WebSocket server running on ws://{self.host}:{self.port} for NFS commands.")
         print(f"WebSocket server running on ws://{self.host}:{self.fs_port} for file transfers.")
@@ -38,6 +68,26 @@ class NFSServer:
         await text_server.wait_closed()
         await binary_server.wait_closed()
     
+    async def run(self):
+        # Serve & persist the file system side by side (start() only returns once the servers are closed)
+        serving = asyncio.gather(self.start(), self.save_fs_periodically())
+        
+        # Catching SIGINT (Ctrl+C) to save state before exiting, handled on the loop (not mid-request)
+        try:
+            asyncio.get_running_loop().add_signal_handler(signal.SIGINT, serving.cancel)
+        except NotImplementedError:
+            # No loop signal handlers (Windows)
+            signal.signal(signal.SIGINT, self.handle_exit)
+        
+        try:
+            await serving
+        except asyncio.CancelledError:
+            pass
+        
+        print("Server shutting down... Saving file system state.")
+        if self.fs._dirty:
+            await asyncio.to_thread(self.fs.save, PERSIST_DIR)
+    
     def handle_exit(self, signum, frame):
         """Gracefully handle shutdown and save the FileSystem state."""
         print("Server shutting down... Saving file system state.")
@@ -45,201 +95,331 @@ class NFSServer:
         sys.exit(0)
     
     async def save_fs_periodically(self):
-        """Periodically save the file system every second."""
+        """Every second, save the file system if it changed since the last save."""
         while True:
             await asyncio.sleep(1)  # Wait for 1 second
+            if not self.fs._dirty:
+                continue
             try:
-                # print("Saving file system state...")
-                self.fs.save(PERSIST_DIR)
+                # Serializing a large tree takes a while, keep it off the event loop
+                await asyncio.to_thread(self.fs.save, PERSIST_DIR)
             except Exception as e:
                 print(f"Error during periodic save: {e}")
 
     async def handle_nfs(self, websocket: websockets.ServerConnection):
         # await websocket.send("Connected to NFS server.\nType 'help' for available commands.\n")
 
-        while True:
-            try:
+        # One try around the whole loop, not one per request
+        try:
+            while True:
                 data = await websocket.recv(decode=False)
                 if not data:
                     break
                 
-                command = json.loads(bytes.decode(data, "utf-8"))  # Expecting a JSON command
-                action = command.get("action", "").lower()
-                
-                if action == "open":
-                    # Decode request
-                    openRequest = OpenRequest()
-                    openRequest.decode(data)
-                    
-                    file_path = openRequest.file_path
-                    
-                    file_node: FileNode = None
-                    
-                    # Set-up the response
-                    openResponse = OpenResponse()
-                    try:
-                        file_node = self.fs.open(file_path)
-                    except Exception as e:
-                        await websocket.send(
-                            openResponse.encode(
-                                msg=f"{e}",
-                                OK=False
-                            )
-                        )
-                    
-                    await websocket.send(
-                        openResponse.encode(
-                            msg=f"File {file_path} opened successfully.",
-                            OK=True,
-                            file_node=file_node
-                        )
-                    )
-                    # END
-                elif action == "close":
-                    closeRequest = CloseRequest()
-                    closeRequest.decode(data)
-                    
-                    file_path = closeRequest.file_node.file_path
-                    file_node: FileNode = None
-                    
-                    closeResponse = CloseResponse()
-                    try:
-                        file_node = self.fs.mutate(file_path, closeRequest.file_node)
-                    except Exception as e:
-                        await websocket.send(
-                            closeResponse.encode(
-                                msg=f"{e}.",
-                                OK=False
-                            )
-                        )
-                    
-                    await websocket.send(
-                        closeResponse.encode(
-                            msg=f"File {file_path} closed successfully.",
-                            OK=True,
-                            file_node=file_node
-                        )
-                    )
-                    # END
-                elif action == "read":
-                    # The client wants to download a file FROM the server
-                    readRequest = ReadRequest()
-                    readRequest.decode(data)
-                    
-                    file_node: FileNode = readRequest.file_node
-                    file_path = file_node.file_path
-                    
-                    readResponse = ReadResponse()
-                    data: bytes = None
-                    
-                    try:
-                        data = self.fs.get_file(file_path)
-                    except Exception as e:
-                        await websocket.send(
-                            readResponse.encode(
-                                msg=f"{e}.",
-                                OK=False
-                            )
-                        )
-                        break
-                    
-                    readResponse.file_node = file_node
-                    readResponse.data = data
-                    await websocket.send(
-                        readResponse.encode(
-                            msg=f"Read data from File {file_path}",
-                            OK=True,
-                            data=readResponse.data
-                        )
-                    )
-                    # END
-                elif action == "write":
-                    writeRequest = WriteRequest()
-                    writeRequest.decode(data)
-                    
-                    file_node: FileNode = writeRequest.file_node
-                    data: bytes = writeRequest.data
-                    
-                    file_path = file_node.file_path
+                if not await self.handle_request(websocket, data):
+                    break
+        except websockets.exceptions.ConnectionClosedOK as e:
+            # print(f"Connection was closed gracefully: {e}")
+            pass
+        except Exception as e:
+            await websocket.send(f"Error: {str(e)}")
 
-                    writeResponse = WriteResponse()
-                    bytes_written: int = 0
-                    
-                    try:
-                        bytes_written = self.fs.save_file(file_path, data)
-                    except Exception as e:
-                        await websocket.send(
-                            writeResponse.encode(
-                                msg=f"{e}.",
-                                OK=False
-                            )
-                        )
-                        break
-                    
-                    assert bytes_written == file_node.size
-                    
-                    await websocket.send(
-                        writeResponse.encode(
-                            msg=f"Wrote data to File {file_path}.",
-                            OK=True,
-                            file_node=file_node,
-                            bytes_written=bytes_written
-                        )
-                    )
-                else:
-                    await websocket.send("Unknown command.\nType 'help' for available commands.")
-            except websockets.exceptions.ConnectionClosedOK as e:
-                # print(f"Connection was closed gracefully: {e}")
-                break
-            except Exception as e:
-                await websocket.send(f"Error: {str(e)}")
-                break
+    async def handle_request(self, websocket: websockets.ServerConnection, data: bytes) -> bool:
+        """Handles a single request, returns False if the connection should be dropped."""
+        command, blob = unpack(data)  # Parsed once, the handlers below reuse it
+        action = command.get("action", "").lower()
+        return await self._dispatch.get(action, self._handle_unknown)(websocket, command, blob)
+    
+    async def _handle_open(self, websocket: websockets.ServerConnection, command: dict, blob: memoryview) -> bool:
+        # Decode request
+        openRequest = OpenRequest()
+        openRequest.decode_parts(command, blob)
+        
+        file_path = openRequest.file_path
+        
+        file_node: FileNode = None
+        
+        # Set-up the response
+        openResponse = self._open_response
+        try:
+            file_node = self.fs.open(file_path)
+        except Exception as e:
+            await websocket.send(
+                openResponse.encode(
+                    msg=f"{e}",
+                    OK=False
+                )
+            )
+            return True
+        
+        await websocket.send(
+            openResponse.encode(
+                msg=f"File {file_path} opened successfully.",
+                OK=True,
+                file_node=file_node
+            )
+        )
+        return True
+    
+    async def _handle_close(self, websocket: websockets.ServerConnection, command: dict, blob: memoryview) -> bool:
+        closeRequest = CloseRequest()
+        closeRequest.decode_parts(command, blob)
+        
+        file_path = closeRequest.file_node.file_path
+        file_node: FileNode = None
+        
+        closeResponse = self._close_response
+        try:
+            self._swap_in_ranges(closeRequest.upload, os.fspath(self.fs.get_file_location(file_path)),
+                                 closeRequest.file_node.size)
+            file_node = self.fs.mutate(file_path, closeRequest.file_node)
+        except Exception as e:
+            await websocket.send(
+                closeResponse.encode(
+                    msg=f"{e}.",
+                    OK=False
+                )
+            )
+            return True
+        
+        await websocket.send(
+            closeResponse.encode(
+                msg=f"File {file_path} closed successfully.",
+                OK=True,
+                file_node=file_node
+            )
+        )
+        return True
+    
+    async def _handle_unknown(self, websocket: websockets.ServerConnection, command: dict, blob: memoryview) -> bool:
+        await websocket.send(self._resp_unknown)
+        return True
 
-    async def handle_file(self, websocket):
-        await websocket.send("Connected to Binary File Transfer server.")
+    async def handle_file(self, websocket: websockets.ServerConnection):
+        # Bulk file transfers (read/write), kept off the command connection so that
+        # a large transfer does not hold up other commands
+        set_socket_buffers(websocket)
 
-        while True:
-            try:
+        # One try around the whole loop, not one per request
+        try:
+            while True:
                 data = await websocket.recv(decode=False)
                 if not data:
                     break
                 
-                command = json.loads(bytes.decode(data, "utf-8"))  # Expecting a JSON command
-                action = command.get("action", "").lower()
-                
-                '''
-                Supported actions:
-                - read
-                - write (over-writes)
-                '''
-                
-                if action == 'read':
-                    # The client wants to download a file FROM the server
-                    
-                    closeRequest = CloseRequest()
-                    closeRequest.decode(data)
-                    
-                    file_path = closeRequest.file_node.file_path
-                    file_node: FileNode = None
-                    
-                    closeResponse = CloseResponse()
-                    
-                    
-                    file_bytes: bytes = self.fs.get_file()
-                    
-                    pass
-                elif action == 'write':
-                    # The client wants to upload a file TO the server
-                    
+                if not await self.handle_transfer(websocket, data):
+                    break
+        except websockets.exceptions.ConnectionClosedOK as e:
+            # print(f"Connection was closed gracefully: {e}")
+            pass
+        except Exception as e:
+            await websocket.send(f"Error: {str(e)}")
+
+    async def handle_transfer(self, websocket: websockets.ServerConnection, data: bytes) -> bool:
+        """
+        Handles a file transfer request, returns False if the connection should be dropped.
+        Supported actions:
+        - read
+        - write (over-writes)
+        """
+        command, blob = unpack(data)  # Parsed once, the handlers below reuse it
+        action = command.get("action", "").lower()
+        return await self._transfer_dispatch.get(action, self._handle_unknown_transfer)(websocket, command, blob)
+    
+    async def _handle_read(self, websocket: websockets.ServerConnection, command: dict, blob: memoryview) -> bool:
+        # The client wants to download a file FROM the server
+        readRequest = ReadRequest()
+        readRequest.decode_parts(command, blob)
+        
+        file_node: FileNode = readRequest.file_node
+        file_path = file_node.file_path
+        
+        readResponse = self._read_response
+        
+        try:
+            file_location = self.fs.get_file_location(file_path)
+            fd = os.open(file_location, os.O_RDONLY)
+        except Exception as e:
+            await websocket.send(
+                readResponse.encode(
+                    msg=f"{e}.",
+                    OK=False
+                )
+            )
+            return False
+        
+        try:
+            # Read front to back once, let the kernel read ahead aggressively
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            await websocket.send(
+                readResponse.encode(
+                    msg=f"Read data from File {file_path}",
+                    OK=True,
+                    length=os.fstat(fd).st_size,
+                    file_node=file_node
+                )
+            )
+            # Followed by the contents, streamed as one fragmented message
+            await websocket.send(iter_file_chunks(fd, self.buffer_pool))
+        finally:
+            os.close(fd)
+        return True
+    
+    async def _handle_write(self, websocket: websockets.ServerConnection, command: dict, blob: memoryview) -> bool:
+        writeRequest = WriteRequest()
+        writeRequest.decode_parts(command, blob)
+        
+        file_node: FileNode = writeRequest.file_node
+        
+        file_path = file_node.file_path
+
+        writeResponse = self._write_response
+        bytes_written: int = 0
+        staging: str = None
+        file_location: str = None
+        upload: str = writeRequest.upload
+        ranges: Set[Tuple[int, int]] = None
+        
+        # The contents follow the header as one fragmented message, write them to disk as they arrive
+        try:
+            file_location = os.fspath(self.fs.get_file_location(file_path))
+            if writeRequest.offset is None:
+                # Supersedes any parallel upload of this file that was abandoned half-way
+                self._discard_staged(file_location)
+                # Whole file, staged next to the current contents & swapped in (os.replace) once complete,
+                # a failed upload leaves the previous version in place
+                staging = f"{file_location}.tmp"
+                fd = os.open(staging, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+                # The size is announced in the header, reserve the blocks before the contents arrive
+                if file_node.size > 0 and hasattr(os, 'posix_fallocate'):
+                    os.posix_fallocate(fd, 0, file_node.size)
+            else:
+                # One range of a parallel upload, filled into the upload's staging file (the stored file is
+                # left alone until every range arrived, see _swap_in_ranges)
+                if not (isinstance(upload, str) and upload.isalnum()):
+                    raise ValueError("A ranged write needs an upload token")
+                location, size, ranges = self._staged_ranges.get(upload, (None, None, None))
+                if location != file_location or size != file_node.size:
+                    # The first range of a new upload, any other upload of this file was abandoned
+                    self._discard_staged(file_location)
+                    if ranges is not None:
+                        self._discard_ranges(upload, ranges)
+                    ranges = set()
+                    self._staged_ranges[upload] = (file_location, file_node.size, ranges)
+                fd = os.open(f"{file_location}.{upload}.part", os.O_WRONLY | os.O_CREAT, 0o644)
+                os.ftruncate(fd, file_node.size)
+            try:
+                bytes_written = await recv_file_chunks(websocket, fd, writeRequest.offset or 0)
+            finally:
+                os.close(fd)
+            if staging is not None and bytes_written == file_node.size:
+                os.replace(staging, file_location)
+                staging = None
+        except Exception as e:
+            if ranges is not None:
+                self._discard_ranges(upload, ranges)
+            await websocket.send(
+                writeResponse.encode(
+                    msg=f"{e}.",
+                    OK=False
+                )
+            )
+            return False
+        finally:
+            # Not swapped in, drop the partial upload
+            if staging is not None:
+                try:
+                    os.unlink(staging)
+                except FileNotFoundError:
                     pass
-                else:
-                    await websocket.send({ "message": "Unknown file command.\n", "OK": False })
-            except websockets.exceptions.ConnectionClosedOK as e:
-                # print(f"Connection was closed gracefully: {e}")
-                break
-            except Exception as e:
-                await websocket.send(f"Error: {str(e)}")
+        
+        # Checked explicitly (asserts are stripped under -O), a short/overlong upload must not be acknowledged
+        if writeRequest.offset is None:
+            expected = file_node.size
+        else:
+            # A range must arrive whole and lie inside the file
+            expected = writeRequest.length
+            if expected is None or writeRequest.offset + expected > file_node.size:
+                expected = -1
+        if bytes_written != expected:
+            if ranges is not None:
+                self._discard_ranges(upload, ranges)
+            await websocket.send(
+                writeResponse.encode(
+                    msg=f"Upload to File {file_path} is incomplete ({bytes_written} bytes received, {expected} expected).",
+                    OK=False
+                )
+            )
+            return True
+        
+        if ranges is not None:
+            if self._staged_ranges.get(upload, (None, None, None))[2] is not ranges:
+                # Another range failed meanwhile and dropped the upload (this range went with it)
+                await websocket.send(
+                    writeResponse.encode(
+                        msg=f"Upload to File {file_path} was aborted.",
+                        OK=False
+                    )
+                )
+                return True
+            ranges.add((writeRequest.offset, bytes_written))
+        
+        await websocket.send(
+            writeResponse.encode(
+                msg=f"Wrote data to File {file_path}.",
+                OK=True,
+                file_node=file_node,
+                bytes_written=bytes_written
+            )
+        )
+        return True
+
+    def _discard_ranges(self, upload: str, ranges: Set[Tuple[int, int]]):
+        """A range failed, drop the whole parallel upload (unless a newer one already replaced it)"""
+        file_location, _, current = self._staged_ranges.get(upload, (None, None, None))
+        if current is not ranges:
+            return
+        del self._staged_ranges[upload]
+        try:
+            os.unlink(f"{file_location}.{upload}.part")
+        except FileNotFoundError:
+            pass
+    
+    def _discard_staged(self, file_location: str):
+        """Drops every parallel upload of the file at file_location (e.g. abandoned by a client that went away)"""
+        for upload, (location, _, ranges) in list(self._staged_ranges.items()):
+            if location == file_location:
+                self._discard_ranges(upload, ranges)
+    
+    def _swap_in_ranges(self, upload: str, file_location: str, size: int):
+        """
+        Swaps the staged parallel upload with the token upload in (os.replace), if there is one.
+        Raises an IOError (and drops the upload) unless it belongs to the file at file_location
+        and its ranges cover the file exactly.
+        """
+        if upload is None:
+            return
+        location, size_staged, ranges = self._staged_ranges.pop(upload, (None, None, None))
+        if ranges is None:
+            raise IOError(f"Upload {upload} not found")
+        staging = f"{location}.{upload}.part"
+        covered = 0
+        for offset, length in sorted(ranges):
+            if offset != covered:
                 break
+            covered += length
+        if location != file_location or size_staged != size or covered != size:
+            try:
+                os.unlink(staging)
+            except FileNotFoundError:
+                pass
+            raise IOError(f"Upload incomplete, {covered} of {size} bytes received")
+        os.replace(staging, file_location)
+    
+    async def _handle_unknown_transfer(self, websocket: websockets.ServerConnection, command: dict, blob: memoryview) -> bool:
+        await websocket.send(self._resp_unknown_file)
+        return True
 
 
 # Command-line argument parsing
@@ -265,6 +445,12 @@ if __name__ == "__main__":
         base_data_folder=args.base_dir
     )
 
+    # uvloop is optional, fall back to the default asyncio event loop if it is missing
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        pass
+
     # Start the WebSocket server
-    asyncio.get_event_loop().run_until_complete(server.start())
-    asyncio.get_event_loop().run_until_complete(server.save_fs_periodically())
+    asyncio.run(server.run())
@@ -1,9 +1,13 @@
 from kazoo.client import KazooClient
 from kazoo.exceptions import NodeExistsError, KazooException
 from typing import Optional
+import logging
 
 from nfs.constants import ZK_HOST, ZK_PORT, ZK_LOCK_NODE
 
+# Silent unless the application configures logging (print takes the stdout lock on every lock check)
+log = logging.getLogger(__name__)
+
 class ZooKeeperManager:
     def __init__(self, host: str = ZK_HOST, port: int = ZK_PORT) -> None:
         """Initialize the ZooKeeperManager with the given host and port."""
@@ -18,9 +22,13 @@ class ZooKeeperManager:
         try:
             self.zk = KazooClient(hosts=f'{self.zk_host}:{self.zk_port}')
             self.zk.start()
-            print(f"Connected to Zookeeper at {self.zk_host}:{self.zk_port}")
+            # A nested lock node needs its parent, the lock node itself must not be created here
+            parent = self.lock_node.rsplit('/', 1)[0]
+            if parent:
+                self.zk.ensure_path(parent)
+            log.info("Connected to Zookeeper at %s:%s", self.zk_host, self.zk_port)
         except KazooException as e:
-            print(f"Failed to connect to Zookeeper: {e}")
+            log.error("Failed to connect to Zookeeper: %s", e)
             self.zk = None
 
     def stop(self) -> None:
@@ -28,52 +36,51 @@ class ZooKeeperManager:
         if self.zk:
             self.zk.stop()
             self.zk.close()
-            print("Disconnected from Zookeeper")
+            log.info("Disconnected from Zookeeper")
 
     def acquire_lock(self) -> bool:
         """Acquire a lock by creating an ephemeral node in Zookeeper."""
         if not self.zk:
-            print("Zookeeper connection is not established. Cannot acquire lock.")
+            log.warning("Zookeeper connection is not established. Cannot acquire lock.")
             return False
         try:
-            # Ensure the lock node exists, create the ephemeral lock node
-            self.zk.ensure_path(self.lock_node)
+            # Create the ephemeral lock node (its parent is created once, in start())
             self.zk.create(self.lock_node, b"", ephemeral=True)
-            print("Lock acquired!")
+            log.debug("Lock acquired!")
             return True
         except NodeExistsError:
-            print("Lock already exists. Unable to acquire lock.")
+            log.debug("Lock already exists. Unable to acquire lock.")
             return False
         except KazooException as e:
-            print(f"Error acquiring lock: {e}")
+            log.error("Error acquiring lock: %s", e)
             return False
 
     def release_lock(self) -> bool:
         """Release the lock by deleting the lock node in Zookeeper."""
         if not self.zk:
-            print("Zookeeper connection is not established. Cannot release lock.")
+            log.warning("Zookeeper connection is not established. Cannot release lock.")
             return False
         try:
             self.zk.delete(self.lock_node)
-            print("Lock released!")
+            log.debug("Lock released!")
             return True
         except KazooException as e:
-            print(f"Error releasing lock: {e}")
+            log.error("Error releasing lock: %s", e)
             return False
 
     def is_locked(self) -> bool:
         """Check if the lock node exists."""
         if not self.zk:
-            print("Zookeeper connection is not established.")
+            log.warning("Zookeeper connection is not established.")
             return False
         try:
             # Check if the lock node exists
             if self.zk.exists(self.lock_node):
-                print("Lock exists.")
+                log.debug("Lock exists.")
                 return True
             else:
-                print("Lock does not exist.")
+                log.debug("Lock does not exist.")
                 return False
         except KazooException as e:
-            print(f"Error checking lock: {e}")
+            log.error("Error checking lock: %s", e)
             return False
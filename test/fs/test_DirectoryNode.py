@@ -31,6 +31,19 @@ class TestDirectoryNode(unittest.TestCase):
         with self.assertRaises(FileExistsError):
             self.root_dir.create_file("file1.txt", "new content")
 
+    def test_get_or_create_file(self):
+        """Test looking up a file, creating it only the first time."""
+        new_file, created = self.root_dir.get_or_create_file("file1.txt", Path("/root/file1.txt"))
+        self.assertTrue(created)
+        self.assertIsInstance(new_file, FileNode)
+        same_file, created = self.root_dir.get_or_create_file("file1.txt", Path("/root/file1.txt"))
+        self.assertFalse(created)
+        self.assertIs(same_file, new_file)
+        
+        self.root_dir.create_directory("subdir")
+        with self.assertRaises(IsADirectoryError):
+            self.root_dir.get_or_create_file("subdir", Path("/root/subdir"))
+
     def test_delete_directory(self):
         """Test deleting a directory."""
         self.root_dir.create_directory("subdir")
@@ -42,6 +55,17 @@ class TestDirectoryNode(unittest.TestCase):
         with self.assertRaises(FileNotFoundError):
             self.root_dir.delete_directory("nonexistent_dir")
 
+    def test_delete_directory_recursive(self):
+        """Test collecting the file IDs below a non-empty directory."""
+        subdir = self.root_dir.create_directory("subdir")
+        nested = subdir.create_directory("nested")
+        file1 = subdir.create_file("file1.txt", Path("root/subdir/file1.txt"))
+        file2 = nested.create_file("file2.txt", Path("root/subdir/nested/file2.txt"))
+        ids = self.root_dir.delete_directory("subdir", recursive=True)
+        self.assertCountEqual(ids, [file1.file_id, file2.file_id])
+        with self.assertRaises(EnvironmentError):
+            self.root_dir.delete_directory("subdir")
+
     def test_delete_file(self):
         """Test deleting a file."""
         self.root_dir.create_file("file1.txt", "content")
@@ -62,6 +86,17 @@ class TestDirectoryNode(unittest.TestCase):
         self.assertTrue("new_subdir" in self.root_dir.children)
         self.assertFalse("subdir" in self.root_dir.children)
 
+    def test_rename_nested_directory(self):
+        """Test renaming a directory updates the paths & IDs of files in nested directories."""
+        subdir = self.root_dir.create_directory("subdir")
+        nested = subdir.create_directory("nested")
+        file = nested.create_file("file1.txt", Path("root/subdir/nested/file1.txt"))
+        old_id = file.file_id
+        ids = self.root_dir.rename_directory("subdir", "new_subdir")
+        self.assertEqual(file.file_path, Path("root/new_subdir/nested/file1.txt"))
+        self.assertEqual(file.file_id, file.generate_file_id())
+        self.assertEqual(ids, [[old_id, file.file_id]])
+
     def test_rename_directory_not_found(self):
         """Test renaming a directory that doesn't exist."""
         with self.assertRaises(FileNotFoundError):
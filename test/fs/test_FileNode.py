@@ -1,5 +1,6 @@
 import unittest
 import hashlib
+import pickle
 from pathlib import Path
 from unittest.mock import patch, mock_open
 from nfs.fs import FileNode
@@ -40,6 +41,25 @@ class TestFileNode(unittest.TestCase):
     #     self.assertEqual(self.file_node.modified_at, 3000000)  # Check if modified_at was updated correctly
     #     mock_file.assert_called_with(self.file_node.file_path, 'w')  # Ensure file was written with new content
     
+    def test_pickle(self):
+        """Test that pickling keeps every attribute and does not regenerate the file ID."""
+        self.file_node.size = 42
+        with patch.object(FileNode, 'generate_file_id') as generate_file_id:
+            restored = pickle.loads(pickle.dumps(self.file_node, protocol=5))
+        generate_file_id.assert_not_called()
+        self.assertEqual(restored.__dict__, self.file_node.__dict__)
+        self.assertIsInstance(restored.file_path, Path)
+    
+    def test_pickled(self):
+        """Test that the pickled bytes are reused until the node changes."""
+        blob = self.file_node.pickled()
+        self.assertIs(self.file_node.pickled(), blob)
+        
+        self.file_node.size = 7
+        changed = self.file_node.pickled()
+        self.assertIsNot(changed, blob)
+        self.assertEqual(pickle.loads(changed).size, 7)
+    
     def test_repr(self):
         """Test the string representation of the FileNode."""
         expected_repr = f"FileNode(name={self.file_node.name}, file_id={self.file_node.file_id}, file_path={self.file_node.file_path}, created_at=1000000, modified_at=1000000)"
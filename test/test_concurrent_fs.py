@@ -1,9 +1,13 @@
 import unittest
+import concurrent.futures
+import os
+import stat
+import shutil
+import tempfile
 import threading
 import time
-from pathlib import Path
 
-from nfs.fs.FileSystem import FileSystem
+from nfs.fs.FileSystem import FileSystem, ShardedLock
 from nfs.fs.DirectoryNode import DirectoryNode
 from nfs.fs.FileNode import FileNode
 
@@ -11,29 +15,13 @@ class TestFileSystem(unittest.TestCase):
 
     def setUp(self):
         # Setup a fresh file system before each test
-        self.base_data_folder: str = "storage"
+        self.base_data_folder: str = tempfile.mkdtemp(prefix="zknfs-")
         self.fs = FileSystem(base_data_folder=self.base_data_folder)
         self.fs.create_directory('/dir1')
 
     def tearDown(self):
         # Clean up after each test
-        # storage_dir = Path('storage')
-        # if storage_dir.exists():
-        #     for item in storage_dir.iterdir():
-        #         if item.is_file():
-        #             item.unlink()
-        #         else:
-        #             self._remove_dir(item)
-        #     storage_dir.rmdir()
-        pass
-
-    def _remove_dir(self, dir_path):
-        for item in dir_path.iterdir():
-            if item.is_file():
-                item.unlink()
-            else:
-                self._remove_dir(item)
-        dir_path.rmdir()
+        shutil.rmtree(self.base_data_folder, ignore_errors=True)
 
     def test_create_file_concurrently(self):
         """Test if file creation is properly synchronized with thread locking"""
@@ -41,13 +29,13 @@ class TestFileSystem(unittest.TestCase):
         def create_file_thread_1(self, file_path: str, content: str):
             """Function to be run by each thread to create a file"""
             file = self.fs.create_file(file_path, content)
-            self.assertTrue(Path(self.fs.base_data_folder).joinpath(file.file_id).exists())
+            self.assertTrue(stat.S_ISREG(os.lstat(os.path.join(self.base_data_folder, file.file_id)).st_mode))  # A regular file, not followed through a symlink
         
         def create_file_thread_2(self, file_path: str, content: str):
             """Function to be run by each thread to create a file"""
             with self.assertRaises(FileExistsError):
               file = self.fs.create_file(file_path, content)
-              self.assertTrue(Path(self.fs.base_data_folder).joinpath(file.file_id).exists())
+              self.assertTrue(stat.S_ISREG(os.lstat(os.path.join(self.base_data_folder, file.file_id)).st_mode))
 
         # Start two threads that will attempt to create the same file concurrently
         thread1 = threading.Thread(target=create_file_thread_1, args=(self, '/dir1/file1.txt', 'Content from thread 1'))
@@ -98,5 +86,56 @@ class TestFileSystem(unittest.TestCase):
         with self.assertRaises(FileNotFoundError):
             self.fs.get_file("/dir1/file_to_delete.txt")
 
+    def test_concurrent_readers(self):
+        """Readers share the lock with each other, a writer waits for them"""
+        self.fs.lock = ShardedLock(shards=2)  # One shard per reader thread, whatever the CPU count
+        self.fs.create_file("/dir1/shared.txt", "shared")
+        
+        reader_inside = threading.Event()
+        release_reader = threading.Event()
+        
+        def hold_read_lock():
+            with self.fs.lock.read():
+                reader_inside.set()
+                release_reader.wait(5)
+        
+        holder = threading.Thread(target=hold_read_lock)
+        holder.start()
+        reader_inside.wait(5)
+        
+        # Another reader gets through while the first one still holds its shard
+        reader = threading.Thread(target=lambda: self.fs.get_file("/dir1/shared.txt"))
+        reader.start()
+        reader.join(5)
+        self.assertFalse(reader.is_alive())
+        
+        # A writer blocks until the reader is done
+        writer = threading.Thread(target=self.fs.create_file, args=("/dir1/written.txt", "written"))
+        writer.start()
+        time.sleep(0.1)
+        self.assertTrue(writer.is_alive())
+        
+        release_reader.set()
+        holder.join(5)
+        writer.join(5)
+        self.assertFalse(writer.is_alive())
+        self.assertEqual(self.fs.get_file("/dir1/written.txt"), b"written")
+
+    def test_concurrent_create_read(self):
+        """Many threads creating & reading back distinct files in the same directory"""
+        count = 256
+        
+        def create_and_read(i: int) -> bytes:
+            self.fs.create_file(f"/dir1/t{i}.txt", f"c{i}")
+            return self.fs.get_file(f"/dir1/t{i}.txt")
+        
+        with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+            contents = list(executor.map(create_and_read, range(count)))
+        
+        self.assertEqual(contents, [f"c{i}".encode('utf-8') for i in range(count)])
+        self.assertEqual(len(self.fs.root.children['dir1'].children), count)
+        for i in range(count):
+            self.assertEqual(self.fs.get_file_node(f"/dir1/t{i}.txt").size, len(f"c{i}"))
+
 if __name__ == '__main__':
     unittest.main(verbosity=2)
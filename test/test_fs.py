@@ -1,38 +1,51 @@
 import unittest
-import threading
+import json
+import os
+import stat
+import shutil
+import tempfile
 from pathlib import Path
+from unittest.mock import patch
 
 from nfs.fs.FileSystem import FileSystem
 from nfs.fs.DirectoryNode import DirectoryNode 
 from nfs.fs.FileNode import FileNode
 
+# File contents shared by the tests, encoded once
+DATA: str = "some example content"
+DATA_BYTES: bytes = DATA.encode('utf-8')
+
 class TestFileSystem(unittest.TestCase):
 
+    @classmethod
+    def setUpClass(cls):
+        # One storage folder for the whole class, emptied after each test,
+        # in a temporary folder (tmpfs on most Linux setups) rather than the working tree
+        cls.base_data_folder: str = tempfile.mkdtemp(prefix="zknfs-")
+        cls.storage_path = Path(cls.base_data_folder)  # Built once, the tests only join file IDs onto it
+
+    @classmethod
+    def tearDownClass(cls):
+        # rmtree walks with os.scandir, no extra stat per entry
+        shutil.rmtree(cls.base_data_folder, ignore_errors=True)
+
     def setUp(self):
-        # Setup a fresh file system before each test
-        self.base_data_folder: str = "storage"
+        # Setup a fresh (empty) tree before each test, on top of the (emptied) storage folder
         self.fs = FileSystem(base_data_folder=self.base_data_folder)
         self.fs.create_directory('/dir1')
 
     def tearDown(self):
-        # Clean up after each test
-        storage_dir = Path('storage')
-        if storage_dir.exists():
-            for item in storage_dir.iterdir():
-                if item.is_file():
-                    item.unlink()
-                else:
-                    self._remove_dir(item)
-            storage_dir.rmdir()
-        pass
+        # Only wipe the storage folder if the test left something in it
+        with os.scandir(self.base_data_folder) as entries:
+            dirty = next(entries, None) is not None
+        if dirty:
+            shutil.rmtree(self.base_data_folder, ignore_errors=True)
+            os.makedirs(self.base_data_folder, exist_ok=True)
 
-    def _remove_dir(self, dir_path):
-        for item in dir_path.iterdir():
-            if item.is_file():
-                item.unlink()
-            else:
-                self._remove_dir(item)
-        dir_path.rmdir()
+    def _storage_ids(self) -> set:
+        """The names in the storage folder (one directory read instead of a stat per file)"""
+        with os.scandir(self.base_data_folder) as entries:
+            return {entry.name for entry in entries}
 
     def test_create_directory(self):
         """
@@ -68,49 +81,70 @@ class TestFileSystem(unittest.TestCase):
                 |- test.txt
         """
         
-        data: str = "some example content"
-        self.fs.create_file("/dir1/test.txt", data)
+        self.fs.create_file("/dir1/test.txt", DATA)
         content = self.fs.get_file("/dir1/test.txt")
-        self.assertEqual(bytes(data, 'utf-8'), content)
+        self.assertEqual(DATA_BYTES, content)
+        
+        # The size is counted in bytes, not characters
+        file2 = self.fs.create_file("/dir1/unicode.txt", "héllo")
+        self.assertEqual(file2.size, len("héllo".encode('utf-8')))
+        self.assertEqual(self.fs.save_file("/dir1/unicode.txt", b""), 0)
+        self.assertEqual(b"", self.fs.get_file("/dir1/unicode.txt"))
 
-    def test_delete_file(self):
+    def test_get_file_location(self):
         """
         --- /
             |- dir1
-                |- file1.txt
-                |- file2.txt
+                |- test.txt
         """
         
-        data: str = "some example content"
-        file1 = self.fs.create_file("/dir1/file1.txt", data)
-        self.assertTrue(Path(self.fs.base_data_folder).joinpath(file1.file_id).exists())
-        content = self.fs.get_file("/dir1/file1.txt")
-        self.assertEqual(bytes(data, 'utf-8'), content)
-        
-        file2 = self.fs.create_file('/dir1/file2.txt', 'File to delete')
-        self.assertTrue(Path(self.fs.base_data_folder).joinpath(file2.file_id).exists())
-        content = self.fs.get_file("/dir1/file2.txt")
-        self.assertEqual(b'File to delete', content)
-        self.fs.delete_file('/dir1/file2.txt')
+        file1 = self.fs.create_file("/dir1/test.txt", DATA)
+        location = self.fs.get_file_location("/dir1/test.txt")
+        self.assertEqual(self.storage_path / file1.file_id, location)
+        self.assertEqual(DATA_BYTES, location.read_bytes())
         with self.assertRaises(FileNotFoundError):
-            self.fs.root.children['dir1'].delete_file('file2.txt')
-        self.assertFalse(Path(self.fs.base_data_folder).joinpath(file2.file_id).exists())
-    
-    def test_delete_non_empty_dir(self):
+            self.fs.get_file_location("/dir1/missing.txt")
+
+    def test_file_lifecycle(self):
         """
         --- /
             |- dir1
                 |- file1.txt
+                |- file_del.txt (deleted)
+                |- file_ren.txt -> file3.txt (renamed)
         """
         
-        data: str = "some example content"
-        file1 = self.fs.create_file("/dir1/file1.txt", data)
-        self.assertTrue(Path(self.fs.base_data_folder).joinpath(file1.file_id).exists())
-        content = self.fs.get_file("/dir1/file1.txt")
-        self.assertEqual(bytes(data, 'utf-8'), content)
+        # Shared prelude: one file on disk, for all of the steps below
+        file1 = self.fs.create_file("/dir1/file1.txt", DATA)
+        self.assertTrue(stat.S_ISREG(os.lstat(os.path.join(self.base_data_folder, file1.file_id)).st_mode))  # A regular file, not followed through a symlink
+        self.assertIsInstance(file1.file_path, Path)
+        
+        with self.subTest("non_empty_dir"):
+            with self.assertRaises(EnvironmentError):
+                self.fs.delete_directory("/dir1")
         
-        with self.assertRaises(EnvironmentError):
-            self.fs.delete_directory("/dir1")
+        # Each step works on its own file & only compares the stored file IDs it created,
+        # so that a failing step does not take the others down with it
+        with self.subTest("delete"):
+            file_del = self.fs.create_file('/dir1/file_del.txt', 'File to delete')
+            created = {file_del.file_id}
+            self.assertSetEqual(created, self._storage_ids() & created)
+            
+            self.fs.delete_file('/dir1/file_del.txt')
+            with self.assertRaises(FileNotFoundError):
+                self.fs.root.children['dir1'].delete_file('file_del.txt')
+            self.assertSetEqual(set(), self._storage_ids() & created)
+        
+        with self.subTest("rename"):
+            file_ren = self.fs.create_file('/dir1/file_ren.txt', 'File to rename')
+            created = {file_ren.file_id}
+            self.assertSetEqual(created, self._storage_ids() & created)
+            
+            self.fs.rename_file("/dir1/file_ren.txt", "file3.txt")
+            file3 = self.fs.get_file_node("/dir1/file3.txt")
+            created.add(file3.file_id)
+            self.assertSetEqual({file3.file_id}, self._storage_ids() & created)
+            self.assertEqual(b'File to rename', self.fs.get_file("/dir1/file3.txt"))
     
     def test_rename_directory(self):
         """
@@ -127,38 +161,181 @@ class TestFileSystem(unittest.TestCase):
         dir2 = self.fs.root.children['dir2']
         self.assertIsInstance(dir2, DirectoryNode)
         self.assertEqual(dir2.name, 'dir2')
+        file1 = self.fs.create_file('/dir2/file1.txt', DATA)
+        old_id = file1.file_id
         
         self.fs.rename_directory("/dir2", "dir3")
         self.assertEqual(dir2.name, 'dir3')
+        
+        # The contents moved on disk along with the file ID
+        self.assertNotEqual(old_id, file1.file_id)
+        self.assertSetEqual({file1.file_id}, self._storage_ids())
+        with open(os.path.join(self.base_data_folder, file1.file_id), 'rb') as f:
+            self.assertEqual(DATA_BYTES, f.read())
     
-    def test_rename_file(self):
+    def test_rename_directory_rollback(self):
+        """A rename that fails half way (a missing backing file) leaves the tree, the index and the disk as they were"""
+        self.fs.create_directory('/dir2')
+        file1 = self.fs.create_file('/dir2/file1.txt', 'content 1')
+        file2 = self.fs.create_file('/dir2/file2.txt', 'content 2')
+        old_ids = {file1.file_id, file2.file_id}
+        os.remove(os.path.join(self.base_data_folder, file2.file_id))
+        
+        with self.assertRaises(FileNotFoundError):
+            self.fs.rename_directory('/dir2', 'dir3')
+        
+        self.assertEqual(sorted(self.fs.root.list()), ['dir1', 'dir2'])
+        self.assertEqual({file1.file_id, file2.file_id}, old_ids)
+        self.assertSetEqual({file1.file_id}, self._storage_ids())
+        self.assertEqual(b'content 1', self.fs.get_file('/dir2/file1.txt'))
+        with self.assertRaises(FileNotFoundError):
+            self.fs.get_file_node('/dir3/file1.txt')
+    
+    def test_path_index(self):
         """
         --- /
             |- dir1
+            |- dir2
                 |- file1.txt
-                |- file2.txt
         
         --- /
             |- dir1
+            |- dir3
                 |- file1.txt
-                |- file3.txt
         """
         
-        data: str = "some example content"
-        file1 = self.fs.create_file("/dir1/file1.txt", data)
-        self.assertTrue(Path(self.fs.base_data_folder).joinpath(file1.file_id).exists())
-        self.assertTrue(isinstance(file1.file_path, Path))
-        content = self.fs.get_file("/dir1/file1.txt")
-        self.assertEqual(bytes(data, 'utf-8'), content)
+        self.fs.create_directory('/dir2')
+        file1 = self.fs.create_file('/dir2/file1.txt', 'content')
+        self.assertIs(self.fs.get_file_node('/dir2/file1.txt'), file1)
+        
+        self.fs.rename_directory('/dir2', 'dir3')
+        self.assertIs(self.fs.get_file_node('/dir3/file1.txt'), file1)
+        self.assertEqual(b'content', self.fs.get_file('/dir3/file1.txt'))
+        with self.assertRaises(FileNotFoundError):
+            self.fs.get_file_node('/dir2/file1.txt')
+        
+        # The index is rebuilt when the tree is loaded from disk
+        persist = self.storage_path / 'persist'
+        self.fs.save(persist)
+        fs = FileSystem(base_data_folder=self.base_data_folder)
+        fs.load(persist)
+        self.assertEqual(fs.get_file_node('/dir3/file1.txt').name, 'file1.txt')
+
+    def test_open_creates_directories(self):
+        """
+        --- /
+            |- dir1
+                |- dir1
+                    |- dir4
+                        |- file1.txt
+        """
         
-        file2 = self.fs.create_file('/dir1/file2.txt', 'File to delete')
-        self.assertTrue(Path(self.fs.base_data_folder).joinpath(file2.file_id).exists())
-        content = self.fs.get_file("/dir1/file2.txt")
-        self.assertEqual(b'File to delete', content)
+        file1 = self.fs.open('/dir1/dir1/dir4/file1.txt')
+        self.assertIs(self.fs.get_file_node('/dir1/dir1/dir4/file1.txt'), file1)
+        self.assertIs(self.fs.root.children['dir1'].children['dir1'].children['dir4'].children['file1.txt'], file1)
+        
+        # Opening again returns the same node from the path index, without walking the tree or creating anything
+        with patch.object(self.fs, '_descend') as descend:
+            self.assertIs(self.fs.open('/dir1/dir1/dir4/file1.txt'), file1)
+            self.assertIs(self.fs.open(Path('/dir1/dir1/dir4/file1.txt')), file1)
+        descend.assert_not_called()
+        
+        # A directory is not a file to open
+        with self.assertRaises(IsADirectoryError):
+            self.fs.open('/dir1/dir1')
+        self.assertEqual(self.fs.root.children['dir1'].list(), ['dir1'])
+
+    def test_save_load(self):
+        """
+        --- /
+            |- dir1
+                |- file1.txt
+                |- dir2
+                    |- file2.txt
+        """
+        
+        file1 = self.fs.create_file('/dir1/file1.txt', 'content 1')
+        self.fs.create_directory('/dir1/dir2')
+        file2 = self.fs.create_file('/dir1/dir2/file2.txt', 'content 22')
+        
+        persist = self.storage_path / 'persist'
+        self.fs.save(persist)
+        fs = FileSystem(base_data_folder=self.base_data_folder)
+        with patch.object(FileNode, 'generate_file_id') as generate_file_id:
+            fs.load(persist)
+        generate_file_id.assert_not_called()
+        
+        for file in (file1, file2):
+            loaded = fs.get_file_node(file.file_path.as_posix())
+            self.assertEqual(loaded.__dict__, file.__dict__)
+        self.assertEqual(sorted(fs.root.children['dir1'].list()), ['dir2', 'file1.txt'])
+        self.assertEqual(b'content 22', fs.get_file('/dir1/dir2/file2.txt'))
+    
+    @unittest.skipUnless(os.environ.get("RUN_SLOW"), "set RUN_SLOW=1 to run the bulk tests")
+    def test_bulk_create_and_enumerate(self):
+        """
+        --- /
+            |- dir1
+                |- f0.txt ... f9999.txt
+        """
+        
+        count = 10_000
+        ids = {self.fs.create_file(f"/dir1/f{i}.txt", "x").file_id for i in range(count)}
+        self.assertEqual(count, len(ids))
+        self.assertEqual(count, len(self.fs.root.children['dir1'].list()))
+        
+        # DirEntry.is_file() uses the type from the directory read, no stat per entry
+        with os.scandir(self.base_data_folder) as entries:
+            names = {entry.name for entry in entries if entry.is_file()}
+        self.assertSetEqual(ids, names)
+        
+        for i in range(count):
+            self.fs.delete_file(f"/dir1/f{i}.txt")
+        self.assertSetEqual(set(), self._storage_ids())
+        self.assertEqual([], self.fs.root.children['dir1'].list())
+    
+    def test_dirty(self):
+        persist = self.storage_path / 'persist'
+        self.assertTrue(self.fs._dirty)  # /dir1 from setUp
+        self.fs.save(persist)
+        self.assertFalse(self.fs._dirty)
+        
+        self.fs.create_file('/dir1/file1.txt', 'content 1')
+        self.assertTrue(self.fs._dirty)
+        
+        self.fs.save(persist)
+        self.assertFalse(self.fs._dirty)
+        self.fs.get_file('/dir1/file1.txt')
+        self.assertFalse(self.fs._dirty)
+        
+        self.fs.rename_file('/dir1/file1.txt', 'file2.txt')
+        self.assertTrue(self.fs._dirty)
+    
+    def test_rename_file_save_load(self):
+        """The file ID of a renamed file is derived from its new path, so it survives a reload"""
+        self.fs.create_file('/dir1/file1.txt', 'content')
+        self.fs.rename_file('/dir1/file1.txt', 'file2.txt')
+        
+        persist = self.storage_path / 'persist'
+        self.fs.save(persist)
+        fs = FileSystem(base_data_folder=self.base_data_folder)
+        fs.load(persist)
+        self.assertEqual(b'content', fs.get_file('/dir1/file2.txt'))
+    
+    def test_load_nested_snapshot(self):
+        """Snapshots written as one nested JSON document can still be loaded"""
+        file1 = self.fs.create_file('/dir1/file1.txt', 'content')
         
-        self.fs.rename_file("/dir1/file2.txt", "file3.txt")
-        content = self.fs.get_file("/dir1/file3.txt")
-        self.assertEqual(b'File to delete', content)
+        persist = self.storage_path / 'persist'
+        persist.write_text(json.dumps({"type": "directory", "name": "/", "children": {
+            "dir1": {"type": "directory", "name": "dir1", "children": {
+                "file1.txt": {"type": "file", "name": "file1.txt", "size": file1.size, "file_path": "/dir1/file1.txt", "file_id": file1.file_id, "created_at": file1.created_at, "modified_at": file1.modified_at}
+            }}
+        }}))
+        fs = FileSystem(base_data_folder=self.base_data_folder)
+        fs.load(persist)
+        self.assertEqual(fs.get_file_node('/dir1/file1.txt').file_id, file1.file_id)
+        self.assertEqual(b'content', fs.get_file('/dir1/file1.txt'))
 
 if __name__ == '__main__':
     unittest.main(verbosity=2)
@@ -0,0 +1,176 @@
+import unittest
+import asyncio
+import os
+import shutil
+import tempfile
+from pathlib import Path
+
+from nfs.fs.FileNode import FileNode
+from nfs.packet import OpenRequest, OpenResponse, \
+    CloseRequest, CloseResponse, \
+    ReadRequest, ReadResponse, \
+    WriteRequest, WriteResponse, \
+    BufferPool, pack, unpack, iter_file_chunks, recv_file_chunks
+
+class FakeWebSocket:
+    """Stands in for a connection whose next message arrives as the given fragments"""
+
+    def __init__(self, fragments):
+        self.fragments = fragments
+
+    async def recv_streaming(self, decode=None):
+        for fragment in self.fragments:
+            yield fragment
+
+class TestPacket(unittest.TestCase):
+
+    def setUp(self):
+        self.file_node = FileNode("file1.txt", Path("/dir1/file1.txt"))
+        self.file_node.size = 42
+
+    def assertNodeEqual(self, expected: FileNode, actual: FileNode):
+        self.assertIsInstance(actual, FileNode)
+        self.assertEqual(expected.name, actual.name)
+        self.assertEqual(expected.file_path, actual.file_path)
+        self.assertEqual(expected.file_id, actual.file_id)
+        self.assertEqual(expected.size, actual.size)
+        self.assertEqual(expected.created_at, actual.created_at)
+        self.assertEqual(expected.modified_at, actual.modified_at)
+
+    def test_pack_unpack(self):
+        header = {"action": "open", "OK": True, "length": 7, "message": "café"}
+        for blob in (b"", b"\x00\x01 raw bytes \xff"):
+            with self.subTest(blob=blob):
+                obj, view = unpack(pack(header, blob))
+                self.assertEqual(header, obj)
+                self.assertIsInstance(view, memoryview)
+                self.assertEqual(blob, bytes(view))
+
+    def test_open_request(self):
+        openRequest = OpenRequest()
+        openRequest.decode(OpenRequest().encode(Path("/dir1/file1.txt")))
+        self.assertEqual("open", openRequest.action)
+        self.assertEqual(Path("/dir1/file1.txt"), openRequest.file_path)
+
+    def test_responses(self):
+        for cls in (OpenResponse, CloseResponse):
+            for file_node in (self.file_node, None):
+                with self.subTest(cls=cls.__name__, file_node=file_node):
+                    response = cls()
+                    response.decode(cls().encode(msg="done", OK=True, file_node=file_node))
+                    self.assertEqual("done", response.message)
+                    self.assertTrue(response.OK)
+                    if file_node is None:
+                        self.assertIsNone(response.file_node)
+                    else:
+                        self.assertNodeEqual(file_node, response.file_node)
+
+    def test_close_request(self):
+        for file_node, upload in ((self.file_node, None), (self.file_node, "abc123"), (None, None)):
+            with self.subTest(file_node=file_node, upload=upload):
+                closeRequest = CloseRequest()
+                closeRequest.decode(CloseRequest().encode(file_node, upload=upload))
+                self.assertEqual("close", closeRequest.action)
+                self.assertEqual(upload, closeRequest.upload)
+                if file_node is None:
+                    self.assertIsNone(closeRequest.file_node)
+                else:
+                    self.assertNodeEqual(file_node, closeRequest.file_node)
+
+    def test_read_request(self):
+        for file_node in (self.file_node, None):
+            with self.subTest(file_node=file_node):
+                readRequest = ReadRequest()
+                readRequest.decode(ReadRequest().encode(file_node))
+                if file_node is None:
+                    self.assertIsNone(readRequest.file_node)
+                else:
+                    self.assertNodeEqual(file_node, readRequest.file_node)
+
+    def test_read_response(self):
+        readResponse = ReadResponse()
+        readResponse.decode(ReadResponse().encode(msg="read", OK=True, length=42, file_node=self.file_node))
+        self.assertEqual("read", readResponse.message)
+        self.assertTrue(readResponse.OK)
+        self.assertEqual(42, readResponse.length)
+        self.assertNodeEqual(self.file_node, readResponse.file_node)
+
+        readResponse.decode(ReadResponse().encode(msg="missing", OK=False))
+        self.assertFalse(readResponse.OK)
+        self.assertEqual(-1, readResponse.length)
+        self.assertIsNone(readResponse.file_node)
+
+    def test_write_request(self):
+        for offset, length, upload in ((None, None, None), (0, 10, "abc123"), (10, 32, "abc123")):
+            with self.subTest(offset=offset, length=length):
+                writeRequest = WriteRequest()
+                writeRequest.decode(WriteRequest().encode(self.file_node, offset=offset, length=length, upload=upload))
+                self.assertEqual(offset, writeRequest.offset)
+                self.assertEqual(length, writeRequest.length)
+                self.assertEqual(upload, writeRequest.upload)
+                self.assertNodeEqual(self.file_node, writeRequest.file_node)
+
+    def test_write_response(self):
+        writeResponse = WriteResponse()
+        writeResponse.decode(WriteResponse().encode(msg="wrote", OK=True, file_node=self.file_node, bytes_written=42))
+        self.assertEqual("wrote", writeResponse.message)
+        self.assertTrue(writeResponse.OK)
+        self.assertEqual(42, writeResponse.bytes_written)
+        self.assertNodeEqual(self.file_node, writeResponse.file_node)
+
+        writeResponse.decode(WriteResponse().encode(msg="failed", OK=False))
+        self.assertFalse(writeResponse.OK)
+        self.assertIsNone(writeResponse.file_node)
+
+class TestFileChunks(unittest.TestCase):
+
+    def setUp(self):
+        self.folder: str = tempfile.mkdtemp(prefix="zknfs-")
+        self.pool = BufferPool(count=1, size=4)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def _open(self, data: bytes, flags: int = os.O_RDONLY, name: str = "file") -> int:
+        path = os.path.join(self.folder, name)
+        with open(path, "wb") as f:
+            f.write(data)
+        fd = os.open(path, flags)
+        self.addCleanup(os.close, fd)
+        return fd
+
+    def _chunks(self, fd: int, **kwargs) -> list:
+        # Each chunk is only valid until the next one is requested, copy it out
+        return [bytes(chunk) for chunk in iter_file_chunks(fd, self.pool, **kwargs)]
+
+    def test_empty_file(self):
+        self.assertEqual([b""], self._chunks(self._open(b"")))
+
+    def test_larger_than_pool(self):
+        self.assertEqual([b"0123", b"4567", b"89"], self._chunks(self._open(b"0123456789")))
+        # The buffer went back to the pool
+        self.assertEqual(1, len(self.pool._free))
+
+    def test_offset_and_length(self):
+        fd = self._open(b"0123456789")
+        self.assertEqual([b"2345", b"67"], self._chunks(fd, offset=2, length=6))
+        self.assertEqual([b"89"], self._chunks(fd, offset=8, length=6))
+        self.assertEqual([b""], self._chunks(fd, offset=3, length=0))
+
+    def test_recv_file_chunks(self):
+        fd = self._open(b"..........", os.O_RDWR)
+        fragments = [b"abc", bytearray(b"de"), memoryview(b"fg")]
+        written = asyncio.run(recv_file_chunks(FakeWebSocket(fragments), fd, offset=2))
+        self.assertEqual(7, written)
+        self.assertEqual(b"..abcdefg.", os.pread(fd, 16, 0))
+
+    def test_round_trip(self):
+        # Streamed out in pool-sized chunks, written back fragment by fragment
+        data = bytes(range(256)) * 3
+        chunks = self._chunks(self._open(data))
+        fd = self._open(b"", os.O_RDWR, name="copy")
+        self.assertEqual(len(data), asyncio.run(recv_file_chunks(FakeWebSocket(chunks), fd)))
+        self.assertEqual(data, os.pread(fd, len(data) + 1, 0))
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
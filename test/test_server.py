@@ -0,0 +1,124 @@
+import unittest
+import asyncio
+import os
+import shutil
+import tempfile
+from unittest.mock import patch
+
+from nfs.packet import WriteRequest, WriteResponse, unpack, load_node
+
+try:
+    from nfs.server import NFSServer
+except ImportError:     # websockets is not installed
+    NFSServer = None
+
+# Old & new contents of the uploaded file, the same size on purpose
+OLD_BYTES: bytes = b"old contents"
+NEW_BYTES: bytes = b"new contents"
+
+class FakeWebSocket:
+    """Stands in for a server connection: the streamed contents come from fragments, replies are collected"""
+
+    def __init__(self, fragments):
+        self.fragments = fragments
+        self.sent = []
+
+    async def recv_streaming(self, decode=None):
+        for fragment in self.fragments:
+            yield fragment
+
+    async def send(self, data):
+        self.sent.append(data)
+
+@unittest.skipIf(NFSServer is None, "websockets is not installed")
+class TestStagedUploads(unittest.TestCase):
+
+    def setUp(self):
+        self.base_data_folder: str = tempfile.mkdtemp(prefix="zknfs-")
+        # Never pick up a snapshot from the working directory
+        with patch("nfs.server.PERSIST_DIR", os.path.join(self.base_data_folder, "persist")):
+            self.server = NFSServer("127.0.0.1", 0, 0, base_data_folder=self.base_data_folder)
+        self.server.fs.open("/file.txt")
+        self.server.fs.save_file("/file.txt", OLD_BYTES)
+        self.location = os.fspath(self.server.fs.get_file_location("/file.txt"))
+
+    def tearDown(self):
+        shutil.rmtree(self.base_data_folder, ignore_errors=True)
+
+    def _write(self, data: bytes, offset: int = None, upload: str = None) -> WriteResponse:
+        """Sends data through _handle_write, as a whole file (offset None) or one range of upload"""
+        file_node = load_node(self.server.fs.open("/file.txt").pickled())   # The client's copy
+        file_node.size = len(NEW_BYTES)
+        command, blob = unpack(WriteRequest().encode(
+            file_node,
+            offset=offset,
+            length=None if offset is None else len(data),
+            upload=upload
+        ))
+        websocket = FakeWebSocket([data])
+        asyncio.run(self.server._handle_write(websocket, command, blob))
+        writeResponse = WriteResponse()
+        writeResponse.decode(websocket.sent[-1])
+        return writeResponse
+
+    def _contents(self) -> bytes:
+        with open(self.location, "rb") as f:
+            return f.read()
+
+    def _staging_files(self) -> list:
+        return [name for name in os.listdir(self.base_data_folder) if name.endswith(".part")]
+
+    def test_swap_in_complete(self):
+        self.assertTrue(self._write(NEW_BYTES[6:], offset=6, upload="up1").OK)
+        self.assertTrue(self._write(NEW_BYTES[:6], offset=0, upload="up1").OK)
+        # The stored file is left alone until the upload is closed
+        self.assertEqual(OLD_BYTES, self._contents())
+
+        self.server._swap_in_ranges("up1", self.location, len(NEW_BYTES))
+        self.assertEqual(NEW_BYTES, self._contents())
+        self.assertEqual([], self._staging_files())
+        self.assertNotIn("up1", self.server._staged_ranges)
+
+    def test_swap_in_gap(self):
+        self.assertTrue(self._write(NEW_BYTES[6:], offset=6, upload="up1").OK)
+
+        with self.assertRaises(IOError):
+            self.server._swap_in_ranges("up1", self.location, len(NEW_BYTES))
+        self.assertEqual(OLD_BYTES, self._contents())
+        self.assertEqual([], self._staging_files())
+        self.assertNotIn("up1", self.server._staged_ranges)
+
+    def test_swap_in_size_mismatch(self):
+        self.assertTrue(self._write(NEW_BYTES[6:], offset=6, upload="up1").OK)
+        self.assertTrue(self._write(NEW_BYTES[:6], offset=0, upload="up1").OK)
+
+        with self.assertRaises(IOError):
+            self.server._swap_in_ranges("up1", self.location, len(NEW_BYTES) + 1)
+        self.assertEqual(OLD_BYTES, self._contents())
+        self.assertEqual([], self._staging_files())
+
+    def test_abandoned_upload_then_whole_file_write(self):
+        # Every range arrived, but the client went away before closing
+        self.assertTrue(self._write(OLD_BYTES[::-1][:6], offset=0, upload="up1").OK)
+        self.assertTrue(self._write(OLD_BYTES[::-1][6:], offset=6, upload="up1").OK)
+
+        # The next client writes the file whole & closes it without an upload token
+        self.assertTrue(self._write(NEW_BYTES).OK)
+        self.assertEqual([], self._staging_files())
+        self.assertEqual({}, self.server._staged_ranges)
+
+        self.server._swap_in_ranges(None, self.location, len(NEW_BYTES))
+        self.assertEqual(NEW_BYTES, self._contents())
+
+        # The abandoned upload can no longer be swapped in
+        with self.assertRaises(IOError):
+            self.server._swap_in_ranges("up1", self.location, len(NEW_BYTES))
+        self.assertEqual(NEW_BYTES, self._contents())
+
+    def test_ranged_write_needs_token(self):
+        writeResponse = self._write(NEW_BYTES[:6], offset=0)
+        self.assertFalse(writeResponse.OK)
+        self.assertEqual([], self._staging_files())
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)